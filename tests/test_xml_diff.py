@@ -0,0 +1,65 @@
+import importlib.util
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import xml_common
+
+
+def load_script(name, file_name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.load_lxml()
+    return module
+
+
+xml_diff = load_script('xml_diff', 'xml-diff.py')
+
+
+def make_diff(original_xml, modified_xml, xml_path='md/test.xml'):
+    etree = xml_common.etree
+    original_tree = etree.ElementTree(etree.fromstring(original_xml))
+    modified_tree = etree.ElementTree(etree.fromstring(modified_xml))
+    key_rules = xml_common.select_key_rules(xml_common.DEFAULT_KEY_SCHEMA, xml_path)
+    diff_root = xml_diff.generate_diff(original_tree, modified_tree, '  ', key_rules)
+    return original_tree, modified_tree, diff_root
+
+
+def assert_round_trip(original_xml, modified_xml):
+    original_tree, modified_tree, diff_root = make_diff(original_xml, modified_xml)
+    assert xml_diff.verify_diff(original_tree, modified_tree, diff_root) == []
+    return diff_root
+
+
+def test_changed_attribute_of_deep_element_keeps_later_selectors_valid():
+    diff_root = assert_round_trip(
+        '<r><a><b><c name="x">old</c></b></a></r>',
+        '<r><a><b><c v="z">new</c></b></a></r>',
+    )
+    assert all('@name="x"]' not in operation.get('sel') for operation in diff_root)
+
+
+def test_swapped_unkeyed_siblings_with_different_tags():
+    diff_root = assert_round_trip(
+        '<mdscript><cues><cue name="c"><actions>'
+        '<set_value name="$a"/><debug_text text="1"/>'
+        '</actions></cue></cues></mdscript>',
+        '<mdscript><cues><cue name="c"><actions>'
+        '<debug_text text="1"/><set_value name="$a"/>'
+        '</actions></cue></cues></mdscript>',
+    )
+    assert len(diff_root) > 0
+
+
+def test_removed_first_of_unkeyed_siblings_around_another_tag():
+    assert_round_trip(
+        '<mdscript><cues><cue name="c"><actions>'
+        '<set_value name="$x" exact="1"/><debug_text text="2"/><set_value name="$y" exact="2"/>'
+        '</actions></cue></cues></mdscript>',
+        '<mdscript><cues><cue name="c"><actions>'
+        '<debug_text text="2"/><set_value name="$y" exact="2"/>'
+        '</actions></cue></cues></mdscript>',
+    )
@@ -2,34 +2,83 @@ import argparse
 import os
 import sys
 import logging
-from lxml import etree
 import re
+import hashlib
+import copy
+import bisect
+import filecmp
+import threading
+import queue
+import collections
+import contextlib
+import xml_common
+from xml_common import (DEFAULT_KEY_SCHEMA, SELECTOR_ATTRIBUTES, resolve_selector, apply_operation,
+                        get_cache_entry_path, read_cache_entry, write_cache_entry, load_key_schema, select_key_rules,
+                        xpath_literal, index_children, get_subtree_hash, read_manifest, run_batch,
+                        load_xml_schema, run_writer)
+
+# lxml takes a while to import, so it is loaded by load_lxml once there is XML to process
+etree = None
+
+# Data shared by all partitions of a diff, set in each worker process by init_diff_worker
+worker_state = {}
 
 def get_input(prompt):
     return input(prompt)
 
+def load_lxml():
+    """
+    Imports lxml on first use, so the help and the argument errors are shown without waiting for it.
+    Worker processes run it as their initializer.
+    """
+    global etree
+    if etree is None:
+        xml_common.load_lxml()
+        etree = xml_common.etree
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Generate XML diff between two XML files or directories.')
     parser.add_argument('original_xml', nargs='?', help='Path to the original XML file or directory')
     parser.add_argument('modified_xml', nargs='?', help='Path to the modified XML file or directory')
-    parser.add_argument('diff_xml', nargs='?', help='Path for the output diff XML file or directory')
+    parser.add_argument('diff_xml', nargs='?', help='Path for the output diff XML file or directory, or a .zip, .tar, .tar.gz or .tgz archive '
+                        'for directories, not used with --check')
     parser.add_argument('--xsd', dest='diff_xsd', help='Path to the diff.xsd schema file', default=None)
+    parser.add_argument('--keys', dest='keys_json', help='Path to a JSON file with matching keys per file type', default=None)
+    parser.add_argument('--verify', action='store_true',
+                        help='Verify each generated diff reproduces the modified XML, without writing anything extra')
+    parser.add_argument('--check', action='store_true',
+                        help='Only check whether the files are semantically equal, exit code 1 if not, 2 on errors')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Number of parallel processes for --check (default: number of CPUs), '
+                             'and for comparing large files (default: 1)')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of file pairs to read ahead in parallel with processing directories (default: 0, disabled)')
+    parser.add_argument('--batch', dest='batch', metavar='MANIFEST',
+                        help='Run all jobs listed in a JSON or line-based manifest file, instead of the given paths', default=None)
+    parser.add_argument('--cache-dir', dest='cache_dir', help='Directory to cache indexes of original XML files in', default=None)
+    parser.add_argument('--cache-size', dest='cache_size', type=int, help='Maximum size of the cache in MB (default: 256)',
+                        default=DEFAULT_CACHE_SIZE // (1024 * 1024))
     args = parser.parse_args()
 
-    if not args.original_xml:
+    if not args.original_xml and not args.batch:
         args.original_xml = get_input('Enter path to original XML file or directory: ').strip()
-    if not args.modified_xml:
+    if not args.modified_xml and not args.batch:
         args.modified_xml = get_input('Enter path to modified XML file or directory: ').strip()
-    if not args.diff_xml:
+    if not args.diff_xml and not args.check and not args.batch:
         args.diff_xml = get_input('Enter path for diff XML file or directory: ').strip()
 
     # Convert to absolute paths
-    args.original_xml = os.path.abspath(args.original_xml)
-    args.modified_xml = os.path.abspath(args.modified_xml)
-    args.diff_xml = os.path.abspath(args.diff_xml)
+    args.original_xml = os.path.abspath(args.original_xml) if args.original_xml else None
+    args.modified_xml = os.path.abspath(args.modified_xml) if args.modified_xml else None
+    args.diff_xml = os.path.abspath(args.diff_xml) if args.diff_xml else None
     args.diff_xsd = os.path.abspath(args.diff_xsd) if args.diff_xsd else None
+    args.keys_json = os.path.abspath(args.keys_json) if args.keys_json else None
+    args.cache_dir = os.path.abspath(args.cache_dir) if args.cache_dir else None
+    args.batch = os.path.abspath(args.batch) if args.batch else None
 
-    return args.original_xml, args.modified_xml, args.diff_xml, args.diff_xsd
+    return (args.original_xml, args.modified_xml, args.diff_xml, args.diff_xsd, args.keys_json,
+            args.cache_dir, args.cache_size * 1024 * 1024, args.verify, args.check, args.jobs,
+            args.prefetch, args.batch)
 
 def detect_indentation(xml_path):
     """
@@ -84,7 +133,177 @@ def detect_indentation(xml_path):
 
     return per_level_indent
 
-def generate_xpath(element, root):
+# Minimum number of changed top-level elements for splitting a file's diff between worker processes,
+# smaller files are diffed faster than the workers start
+PARALLEL_DIFF_MIN_CHILDREN = 256
+
+# Output paths with these extensions are packed archives instead of directories
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+def build_key_map(root, key_rules):
+    """
+    Precomputes the identity of every element of the XML tree in a single pass.
+
+    Args:
+        root (etree.Element): The root element of the XML tree.
+        key_rules (dict): Element pattern to list of identity attributes, as returned by select_key_rules.
+
+    Returns:
+        dict: With 'elements' mapping each element to a tuple of its matching key, its XPath step and
+            the attributes suitable for a '//' selector, 'counts' mapping (tag, attribute, value)
+            to the number of elements carrying it in the whole tree, and 'hashes' for the canonical
+            subtree hashes, which are computed on demand.
+    """
+    elements = {root: (root.tag, root.tag, [])}
+    counts = {}
+    rules_cache = {}
+    for parent in root.iter(etree.Element):
+        if len(parent):
+            elements.update(index_children(parent, key_rules, rules_cache, counts))
+    return {'elements': elements, 'counts': counts, 'hashes': {}}
+
+def compute_subtree_hashes(root):
+    """
+    Computes a canonical hash of every subtree of the XML tree.
+
+    Args:
+        root (etree.Element): The root element of the XML tree.
+
+    Returns:
+        dict: Element to the digest of its subtree.
+    """
+    hashes = {}
+    # Children follow their parents in document order, so the reversed order visits them first
+    for elem in reversed(list(root.iter(etree.Element))):
+        get_subtree_hash(elem, hashes)
+    return hashes
+
+def subtrees_equal(original_elem, modified_elem, original_hashes, modified_hashes):
+    """
+    Checks whether two subtrees are equal, ignoring the same things as the comparison.
+
+    Verbatim copies are recognized by their serialization without hashing, which is the common case
+    for the unchanged parts of a modified file.
+
+    Args:
+        original_elem (etree.Element): Element from the original XML.
+        modified_elem (etree.Element): Element from the modified XML.
+        original_hashes (dict): Subtree digests of the original XML, updated in place.
+        modified_hashes (dict): Subtree digests of the modified XML, updated in place.
+
+    Returns:
+        bool: True if the subtrees are equal.
+    """
+    if etree.tostring(original_elem, with_tail=False) == etree.tostring(modified_elem, with_tail=False):
+        return True
+    return get_subtree_hash(original_elem, original_hashes) == get_subtree_hash(modified_elem, modified_hashes)
+
+def read_original_xml(original_xml_path, key_rules, cache_dir=None):
+    """
+    Reads and parses the original XML file and looks up the cache entry with its indexes.
+
+    Args:
+        original_xml_path (str): Path to the original XML file.
+        key_rules (dict): Matching keys for the file.
+        cache_dir (str): Path to the cache directory, or None to disable the cache.
+
+    Returns:
+        tuple: The parsed etree.ElementTree, the cache entry or None, and the cache entry path or None.
+    """
+    with open(original_xml_path, 'rb') as f:
+        content = f.read()
+    original_tree = etree.ElementTree(etree.fromstring(content, etree.XMLParser(), base_url=original_xml_path))
+
+    entry = entry_path = None
+    if cache_dir:
+        entry_path = get_cache_entry_path(cache_dir, hashlib.sha256(content).hexdigest(), key_rules)
+        entry = read_cache_entry(entry_path)
+    return original_tree, entry, entry_path
+
+def index_original_xml(original_tree, original_xml_path, key_rules, entry=None, entry_path=None,
+                       cache_size=DEFAULT_CACHE_SIZE):
+    """
+    Returns the derived indexes of the original XML: the indentation and the key map.
+    They are taken from the cache entry if possible, otherwise built and stored into the cache.
+
+    Args:
+        original_tree (etree.ElementTree): The parsed original XML tree.
+        original_xml_path (str): Path to the original XML file.
+        key_rules (dict): Matching keys for the file.
+        entry (dict): The cache entry as returned by read_original_xml, or None.
+        entry_path (str): Path to the cache entry file, or None if the cache is disabled.
+        cache_size (int): Maximum total size of the cache directory in bytes.
+
+    Returns:
+        tuple: The indentation string and the key map.
+    """
+    original_root = original_tree.getroot()
+    if entry is not None:
+        elements = list(original_root.iter(etree.Element))
+        if len(elements) == len(entry['elements']):
+            key_map = {
+                'elements': dict(zip(elements, entry['elements'])),
+                'counts': entry['counts'],
+                'hashes': dict(zip(elements, entry['hashes'])),
+            }
+            logging.info(f"Loaded index of original XML from cache: {entry_path}")
+            return entry['indent'], key_map
+        logging.warning(f"Cache entry does not match the original XML, rebuilding: {entry_path}")
+
+    indent_str = detect_indentation(original_xml_path)
+    key_map = build_key_map(original_root, key_rules)
+
+    if entry_path:
+        key_map['hashes'] = compute_subtree_hashes(original_root)
+        elements = list(original_root.iter(etree.Element))
+        write_cache_entry(entry_path, {
+            'version': xml_common.CACHE_VERSION,
+            'indent': indent_str,
+            'elements': [key_map['elements'][elem] for elem in elements],
+            'counts': key_map['counts'],
+            'hashes': [key_map['hashes'][elem] for elem in elements],
+        }, cache_size)
+    return indent_str, key_map
+
+def count_selector_values(root, key_rules):
+    """
+    Counts the values of the identity and selector attributes in the whole XML tree,
+    like the 'counts' of build_key_map, without computing the matching keys.
+
+    Args:
+        root (etree.Element): The root element of the XML tree.
+        key_rules (dict): Element pattern to list of identity attributes, as returned by select_key_rules.
+
+    Returns:
+        dict: Mapping of (tag, attribute, value) to the number of elements carrying it.
+    """
+    attrs = set(SELECTOR_ATTRIBUTES).union(*key_rules.values())
+    counts = {}
+    for elem in root.iter(etree.Element):
+        tag = elem.tag
+        for attr, value in elem.items():
+            if attr in attrs:
+                value_key = (tag, attr, value)
+                counts[value_key] = counts.get(value_key, 0) + 1
+    return counts
+
+def get_modified_counts(modified_key_map):
+    """
+    Returns the counts of the attribute values in the whole modified XML tree, counted on first use.
+
+    Args:
+        modified_key_map (dict): The matching keys of the modified XML tree, as prepared by generate_diff.
+
+    Returns:
+        dict: Mapping of (tag, attribute, value) to the number of elements carrying it.
+    """
+    if 'counts' not in modified_key_map:
+        modified_key_map['counts'] = count_selector_values(modified_key_map['root'], modified_key_map['rules'])
+    return modified_key_map['counts']
+
+def generate_xpath(element, root, key_map=None, step=None, counterpart=None, modified_key_map=None):
     """
     Generates the XPath for a given element within the XML tree.
     Prefers using '//' with attribute-based identification for nested elements
@@ -93,245 +312,796 @@ def generate_xpath(element, root):
     Args:
         element (etree.Element): The element for which to generate the XPath.
         root (etree.Element): The root element of the XML tree.
+        key_map (dict): Precomputed key map of the tree, built with the default keys if not provided.
+        step (str): XPath step of the element itself, instead of the precomputed one.
+        counterpart (etree.Element): The matching element of the modified XML, None if it is removed.
+            A '//' selector is only used for a value the counterpart keeps.
+        modified_key_map (dict): The matching keys of the modified XML tree. If given, a '//' selector is only
+            used for a value which is unique in both trees, so it stays unique while the diff is applied.
 
     Returns:
         str: The XPath expression pointing to the element.
     """
-    # Attempt to create an absolute XPath
-    path = []
-    current = element
-    while current is not None and current is not root:
-        parent = current.getparent()
-        if parent is None:
-            break  # Reached the root
-        siblings = parent.findall(current.tag)
-
-        # Debug: Log current.tag and type
-        if not isinstance(current.tag, str):
-            logging.error(f"current.tag is not a string: {current.tag} (type: {type(current.tag)})")
-            sys.exit(1)
+    if key_map is None:
+        key_map = build_key_map(root, select_key_rules(DEFAULT_KEY_SCHEMA, ''))
+    elements = key_map['elements']
+    steps = key_map.get('steps', {})
 
-        if len(siblings) == 1:
-            path.insert(0, f'/{current.tag}')
-        else:
-            # Use unique attributes for identification
-            unique_attr = None
-            for attr in ['id', 'name', 'key', 'ref', 'value']:  # Add attributes as needed
-                if attr in current.attrib:
-                    unique_attr = attr
-                    break
-            if unique_attr:
-                # Escape quotes in attribute values
-                attr_value = current.attrib[unique_attr].replace('"', '&quot;')
-                path.insert(0, f'/{current.tag}[@{unique_attr}="{attr_value}"]')
-            else:
-                # Fallback to positional index
-                try:
-                    index = siblings.index(current) + 1  # XPath indices are 1-based
-                except ValueError:
-                    logging.error(f"Element {current.tag} not found among its siblings.")
-                    sys.exit(1)
-                path.insert(0, f'/{current.tag}[{index}]')
-        current = parent
+    if element not in elements:
+        logging.error(f"Element {element.tag} is not a part of the XML tree.")
+        sys.exit(1)
+
+    # Create an absolute XPath from the precomputed steps
+    path = [f'/{step or steps.get(element) or elements[element][1]}']
+    current = element.getparent()
+    while current is not None:
+        path.insert(0, f'/{steps.get(current) or elements[current][1]}')
+        current = current.getparent()
     absolute_xpath = ''.join(path)
-    if not absolute_xpath.startswith('/'):
-        absolute_xpath = '/' + absolute_xpath
-
-    # Determine the depth of the element
-    depth = absolute_xpath.count('/')
-
-    # If more than two levels deep, prefer using '//' with attributes
-    if depth > 2:
-        # Attempt to generate a '//tag[@attr="value"]' XPath
-        for attr in ['id', 'name', 'key', 'ref', 'value']:
-            if attr in element.attrib:
-                attr_value = element.attrib[attr].replace('"', '&quot;')
-                xpath = f'//{element.tag}[@{attr}="{attr_value}"]'
-                # Optional: Verify uniqueness
-                try:
-                    matches = root.xpath(xpath)
-                except etree.XPathError as e:
-                    logging.error(f"Invalid XPath generated: {xpath} | Error: {e}")
+
+    # If more than two levels below the root, prefer using '//' with attributes
+    if len(path) > 3:
+        # Attempt to generate a '//tag[@attr="value"]' XPath, which is unique in the whole tree
+        for attr in elements[element][2]:
+            attr_value = element.attrib[attr]
+            value_key = (element.tag, attr, attr_value)
+            if key_map['counts'].get(value_key) != 1:
+                continue
+            # A kept element may lose the value by its own operations, which come before the others using the selector
+            if counterpart is not None and counterpart.get(attr) != attr_value:
+                continue
+            if modified_key_map is not None:
+                kept = 1 if counterpart is not None else 0
+                if get_modified_counts(modified_key_map).get(value_key, 0) != kept:
                     continue
-                if len(matches) == 1:
-                    return xpath
+            return f'//{element.tag}[@{attr}={xpath_literal(attr_value)}]'
         # If no unique attribute found, fallback to absolute XPath
     return absolute_xpath
 
-def generate_key(element, parent_key, index):
-    """
-    Generates a unique key for an element based on a unique identifier or position.
-
-    Args:
-        element (etree.Element): The XML element.
-        parent_key (str): The XPath of the parent element.
-        index (int): The position index of the element among its siblings.
-
-    Returns:
-        str: A unique key for the element.
-    """
-    # Prioritize 'id' attribute if available
-    unique_id = element.get('id')
-    if unique_id:
-        return f"{parent_key}/{element.tag}[@id='{unique_id}']"
-    else:
-        # Fallback to positional index
-        return f"{parent_key}/{element.tag}[{index}]"
-
-def compare_elements(original_elem, modified_elem, diff_root, indent_str, parent_key=''):
+def compare_elements(original_elem, modified_elem, diff_root, indent_str, key_maps=None, matched_pairs=None,
+                     stream=None):
     """
     Compares two XML elements and records the differences as add, replace, or remove operations.
 
+    The operations are applied one after another, while their selectors are built from the original XML.
+    So the changes of the element itself come first, then the ones inside its kept children, and the
+    removed and added children are the last, see append_child_operations. The step of a kept child is
+    used by all operations inside it, when its siblings may already have their modified attributes,
+    so a value identifies it only if no other sibling carries it in either XML, otherwise its position does.
+
     Args:
         original_elem (etree.Element): Element from the original XML.
         modified_elem (etree.Element): Element from the modified XML.
         diff_root (etree.Element): Root of the diff XML tree to append operations.
         indent_str (str): The detected per-level indentation string.
-        parent_key (str): The XPath of the parent element.
+        key_maps (tuple): Precomputed key map of the original XML tree, and the matching keys with
+            the subtree hashes of the modified XML tree, as prepared by generate_diff.
+        matched_pairs (list): If given, the pairs of matching children are collected here in document order
+            instead of being compared, so they can be compared in worker processes. The removed and added
+            children are then left to the caller, for append_child_operations once the pairs are compared.
+        stream (dict): Diff stream opened by open_diff_stream, the finished operations are written to it
+            and removed from diff_root.
+
+    Returns:
+        tuple: The children of both elements mapped by their keys, the modified children's keys and
+            the keys of the kept children, for append_child_operations; None if the whole element is replaced.
     """
-    # Generate unique keys for both elements
-    original_key = generate_key(original_elem, parent_key, 1)  # Assuming first occurrence
-    modified_key = generate_key(modified_elem, parent_key, 1)
+    original_root = original_elem.getroottree().getroot()
+    if key_maps is None:
+        key_rules = select_key_rules(DEFAULT_KEY_SCHEMA, '')
+        key_maps = (build_key_map(original_root, key_rules),
+                    {'rules': key_rules, 'hashes': {}, 'root': modified_elem.getroottree().getroot()})
+    original_key_map, modified_key_map = key_maps
 
     # Compare tag
     if original_elem.tag != modified_elem.tag:
         # Replace the entire element
-        sel = generate_xpath(original_elem, original_elem.getroottree().getroot())
-        replace_op = etree.SubElement(diff_root, 'replace', sel=sel)
+        sel = generate_xpath(original_elem, original_root, original_key_map)
+        replace_op = append_operation(diff_root, 'replace', sel=sel, stream=stream)
         # Clone the modified element
         replacement = etree.fromstring(etree.tostring(modified_elem))
         replace_op.append(replacement)
         logging.debug(f"Replaced entire element '{original_elem.tag}' with '{modified_elem.tag}'.")
-        return
+        return None
 
     # Compare attributes
     original_attrib = original_elem.attrib
     modified_attrib = modified_elem.attrib
 
+    # Compare text
+    original_text = original_elem.text.strip() if original_elem.text else ''
+    modified_text = modified_elem.text.strip() if modified_elem.text else ''
+
+    # The element selector is shared by all attribute and text operations, so it is generated only once
+    element_sel = None
+    if original_attrib != modified_attrib or original_text != modified_text:
+        element_sel = generate_xpath(original_elem, original_root, original_key_map, counterpart=modified_elem,
+                                     modified_key_map=modified_key_map)
+
     # Attributes to add or replace
     for attr, value in modified_attrib.items():
         if attr not in original_attrib:
             # Attribute added
-            sel = f"{generate_xpath(original_elem, original_elem.getroottree().getroot())}/@{attr}"
-            add_op = etree.SubElement(diff_root, 'add', sel=sel, pos='after')
+            add_op = append_operation(diff_root, 'add', sel=element_sel, type=f'@{attr}', stream=stream)
             add_op.text = value
             logging.debug(f"Added attribute '{attr}' with value '{value}' to element '{original_elem.tag}'.")
         elif original_attrib[attr] != value:
             # Attribute replaced
-            sel = f"{generate_xpath(original_elem, original_elem.getroottree().getroot())}/@{attr}"
-            replace_op = etree.SubElement(diff_root, 'replace', sel=sel)
+            replace_op = append_operation(diff_root, 'replace', sel=f"{element_sel}/@{attr}", stream=stream)
             replace_op.text = value
             logging.debug(f"Replaced attribute '{attr}' value from '{original_attrib[attr]}' to '{value}' in element '{original_elem.tag}'.")
 
     # Attributes to remove
     for attr in original_attrib:
         if attr not in modified_attrib:
-            sel = f"{generate_xpath(original_elem, original_elem.getroottree().getroot())}/@{attr}"
-            remove_op = etree.SubElement(diff_root, 'remove', sel=sel)
+            append_operation(diff_root, 'remove', sel=f"{element_sel}/@{attr}", stream=stream)
             logging.debug(f"Removed attribute '{attr}' from element '{original_elem.tag}'.")
 
-    # Compare text
-    original_text = original_elem.text.strip() if original_elem.text else ''
-    modified_text = modified_elem.text.strip() if modified_elem.text else ''
     if original_text != modified_text:
-        sel = generate_xpath(original_elem, original_elem.getroottree().getroot())
         if modified_text:
             # Replace text
-            replace_op = etree.SubElement(diff_root, 'replace', sel=sel)
+            replace_op = append_operation(diff_root, 'replace', sel=element_sel, stream=stream)
             replace_op.text = modified_text
             logging.debug(f"Replaced text in element '{original_elem.tag}' from '{original_text}' to '{modified_text}'.")
         else:
             # Remove text
-            remove_op = etree.SubElement(diff_root, 'remove', sel=f"{sel}/text()")
+            append_operation(diff_root, 'remove', sel=f"{element_sel}/text()", stream=stream)
             logging.debug(f"Removed text from element '{original_elem.tag}'.")
 
-    # Compare children
-    original_children = list(original_elem)
-    modified_children = list(modified_elem)
+    # Build maps with unique keys, comments and processing instructions are skipped.
+    # The original keys are precomputed, the modified ones are only computed where the trees differ.
+    original_elements = original_key_map['elements']
+    original_map = {original_elements[child][0]: child for child in original_elem.iterchildren(etree.Element)}
+    modified_values = {}
+    modified_keys = index_children(modified_elem, modified_key_map['rules'], modified_key_map.setdefault('rules_cache', {}),
+                                   modified_values)
+    modified_map = {modified_keys[child][0]: child for child in modified_elem.iterchildren(etree.Element)}
+    kept = find_kept_keys(original_map, modified_map)
+
+    original_values = {}
+    for child in original_map.values():
+        for attr in original_elements[child][2]:
+            value_key = (child.tag, attr, child.get(attr))
+            original_values[value_key] = original_values.get(value_key, 0) + 1
+
+    # Recursively compare existing children, skipping identical subtrees
+    original_hashes = original_key_map['hashes']
+    modified_hashes = modified_key_map['hashes']
+    steps = original_key_map.setdefault('steps', {})
+    positions = {}
+    for key, original_child in original_map.items():
+        tag = original_child.tag
+        positions[tag] = positions.get(tag, 0) + 1
+        if key not in kept:
+            continue
+        modified_child = modified_map[key]
+        step = original_elements[original_child][1]
+        if step.startswith(f'{tag}[@'):
+            # Choose the step of the kept child, the tag alone and positions do not depend on the attributes
+            steps[original_child] = f'{tag}[{positions[tag]}]'
+            for attr in original_elements[original_child][2]:
+                value = original_child.get(attr)
+                value_key = (tag, attr, value)
+                if original_values[value_key] == 1 and modified_values.get(value_key) == 1 and modified_child.get(attr) == value:
+                    steps[original_child] = f'{tag}[@{attr}={xpath_literal(value)}]'
+                    break
+        if matched_pairs is not None:
+            matched_pairs.append((original_child, modified_child))
+        elif not subtrees_equal(original_child, modified_child, original_hashes, modified_hashes):
+            # Recursive comparison
+            compare_elements(original_child, modified_child, diff_root, indent_str, key_maps=key_maps, stream=stream)
+
+    children = (original_map, modified_map, modified_keys, kept)
+    if matched_pairs is None:
+        append_child_operations(original_elem, modified_elem, children, diff_root, key_maps, stream)
+    return children
+
+def find_kept_keys(original_map, modified_map):
+    """
+    Chooses the matched children which are kept, the others are removed and added again.
+
+    The diff operations cannot move an element, so the kept children must be in the same order in both
+    elements. Of the children matched by their keys, the longest sequence in the same order is kept,
+    e.g. for two unkeyed siblings with different tags which swapped their places, only one of them is.
+
+    Args:
+        original_map (dict): Keys of the original children to the children, in document order.
+        modified_map (dict): Keys of the modified children to the children, in document order.
+
+    Returns:
+        set: The keys of the kept children.
+    """
+    modified_indexes = {key: index for index, key in enumerate(modified_map)}
+    matched = [key for key in original_map if key in modified_indexes]
+
+    # Longest increasing subsequence of the modified indexes, in the order of the original children
+    tails = []
+    tail_keys = []
+    previous = {}
+    for key in matched:
+        index = modified_indexes[key]
+        length = bisect.bisect_left(tails, index)
+        previous[key] = tail_keys[length - 1] if length else None
+        if length == len(tails):
+            tails.append(index)
+            tail_keys.append(key)
+        else:
+            tails[length] = index
+            tail_keys[length] = key
+
+    kept = set()
+    key = tail_keys[-1] if tail_keys else None
+    while key is not None:
+        kept.add(key)
+        key = previous[key]
+    if len(kept) < len(matched):
+        logging.debug(f"{len(matched) - len(kept)} matched child element(s) moved, they are removed and added again.")
+    return kept
+
+def append_child_operations(original_elem, modified_elem, children, diff_root, key_maps, stream=None):
+    """
+    Records the removed and added children of an element, after all operations inside its kept children.
 
-    # Build maps with unique keys
-    original_map = {}
-    for index, child in enumerate(original_children, start=1):
-        if not isinstance(child.tag, str):
-            logging.error(f"Expected 'child.tag' to be str, but got {type(child.tag)}. Skipping this child.")
-            continue  # Skip or handle as needed
+    The operations go from the last child to the first one, so the preceding siblings of each target
+    are still the original ones when it is applied, and its position among them is valid. The tag and
+    the attribute values identify a target only if they are unique among the siblings present by then.
 
-        key = generate_key(child, original_key, index)
-        original_map[key] = child
+    Consecutive new siblings are collected into a single run, which is anchored on the nearest sibling
+    that is kept from the original, so the anchor always exists when applied.
 
-    modified_map = {}
-    for index, child in enumerate(modified_children, start=1):
-        if not isinstance(child.tag, str):
-            logging.error(f"Expected 'child.tag' to be str, but got {type(child.tag)}. Skipping this child.")
-            continue  # Skip or handle as needed
+    Args:
+        original_elem (etree.Element): Element from the original XML.
+        modified_elem (etree.Element): The matching element from the modified XML.
+        children (tuple): The children matched by compare_elements.
+        diff_root (etree.Element): Root of the diff XML tree to append operations.
+        key_maps (tuple): The key maps prepared by generate_diff.
+        stream (dict): Diff stream opened by open_diff_stream, or None to keep all operations in diff_root.
+    """
+    original_root = original_elem.getroottree().getroot()
+    original_key_map, modified_key_map = key_maps
+    original_elements = original_key_map['elements']
+    original_map, modified_map, modified_keys, kept = children
+
+    # Sort positions of the operations: a removal at the index of the removed child, a run right after its
+    # preceding kept sibling, or right before the first kept one, following the removed children before it
+    indexes = {key: index for index, key in enumerate(original_map)}
+    operations = [((indexes[key], 0), key, None, None) for key in original_map if key not in kept]
+    previous_kept = None
+    new_run = []
+    for key, elem in modified_map.items():
+        if key not in kept:
+            new_run.append(elem)
+            continue
+        if new_run:
+            if previous_kept is not None:
+                operations.append(((indexes[previous_kept], 1), previous_kept, 'after', new_run))
+            else:
+                operations.append(((indexes[key], -1), key, 'before', new_run))
+            new_run = []
+        previous_kept = key
+    if new_run:
+        if previous_kept is not None:
+            operations.append(((indexes[previous_kept], 1), previous_kept, 'after', new_run))
+        else:
+            # No kept siblings at all, append to the parent
+            operations.append(((len(original_map), 0), None, None, new_run))
+    if not operations:
+        return
 
-        key = generate_key(child, original_key, index)
-        modified_map[key] = child
+    # The siblings before the operations: the kept ones with their modified attributes
+    tag_counts = {}
+    value_counts = {}
+    positions = {}
+    tag_positions = {}
+    for key, child in original_map.items():
+        tag_positions[child.tag] = tag_positions.get(child.tag, 0) + 1
+        positions[key] = tag_positions[child.tag]
+        if key in kept:
+            update_sibling_counts(modified_map[key], modified_keys[modified_map[key]][2], tag_counts, value_counts, 1)
+        else:
+            update_sibling_counts(child, original_elements[child][2], tag_counts, value_counts, 1)
 
-    # Detect removed elements
-    for key in original_map:
-        if key not in modified_map:
+    for _, key, pos, new_run in sorted(operations, key=lambda operation: operation[0], reverse=True):
+        if new_run is None:
             elem = original_map[key]
-            sel = generate_xpath(elem, original_elem.getroottree().getroot())
-            remove_op = etree.SubElement(diff_root, 'remove', sel=sel)
+            step = get_sibling_step(elem, original_elements[elem][2], positions[key], tag_counts, value_counts)
+            sel = generate_xpath(elem, original_root, original_key_map, step=step, modified_key_map=modified_key_map)
+            append_operation(diff_root, 'remove', sel=sel, stream=stream)
             logging.debug(f"Marked element '{elem.tag}' for removal.")
+            update_sibling_counts(elem, original_elements[elem][2], tag_counts, value_counts, -1)
+            continue
 
-    # Detect added elements by comparing unique keys
-    for key in modified_map:
-        if key not in original_map:
-            elem = modified_map[key]
-            parent = elem.getparent()
-
-            # Get list of siblings from the parent
-            siblings = list(parent)
-            idx = siblings.index(elem)  # index of the newly added element among its parent's children
-
-            # Determine position relative to siblings
-            if idx > 0:
-                # We have a previous sibling
-                ref_sibling = siblings[idx - 1]
-                sel = generate_xpath(ref_sibling, original_elem.getroottree().getroot())
-                pos = 'after'
-            else:
-                # No previous sibling, try next sibling for "before"
-                if len(siblings) > 1:
-                    ref_sibling = siblings[idx + 1]
-                    sel = generate_xpath(ref_sibling, original_elem.getroottree().getroot())
-                    pos = 'before'
-                else:
-                    # No siblings at all, fallback to parent
-                    sel = generate_xpath(parent, original_elem.getroottree().getroot())
-                    pos = 'after'
-
-            add_op = etree.SubElement(diff_root, 'add', sel=sel, pos=pos)
-            add_op.append(etree.fromstring(etree.tostring(elem)))
-            logging.debug(f"Marked '{elem.tag}' for addition {pos} sibling/parent reference.")
-
-    # Recursively compare existing children
-    for key in original_map:
-        if key in modified_map:
-            # Recursive comparison
-            compare_elements(original_map[key], modified_map[key], diff_root, indent_str, parent_key=original_key)
+        if key is None:
+            sel = generate_xpath(original_elem, original_root, original_key_map, counterpart=modified_elem,
+                                 modified_key_map=modified_key_map)
+        else:
+            anchor = modified_map[key]
+            step = get_sibling_step(anchor, modified_keys[anchor][2], positions[key], tag_counts, value_counts)
+            sel = generate_xpath(original_map[key], original_root, original_key_map, step=step, counterpart=anchor,
+                                 modified_key_map=modified_key_map)
+        add_new_run(diff_root, new_run, sel, pos, stream)
+        for elem in new_run:
+            update_sibling_counts(elem, modified_keys[elem][2], tag_counts, value_counts, 1)
+
+def update_sibling_counts(elem, attrs, tag_counts, value_counts, change):
+    """
+    Updates the counts of the tags and attribute values among the siblings by a sibling added or removed.
+
+    Args:
+        elem (etree.Element): The sibling, with the attribute values it has at that moment.
+        attrs (list): Its attributes used for selectors.
+        tag_counts (dict): Tag to the number of siblings with it, updated in place.
+        value_counts (dict): (tag, attribute, value) to the number of siblings with it, updated in place.
+        change (int): 1 for an added sibling, -1 for a removed one.
+    """
+    tag = elem.tag
+    tag_counts[tag] = tag_counts.get(tag, 0) + change
+    for attr in attrs:
+        value_key = (tag, attr, elem.get(attr))
+        value_counts[value_key] = value_counts.get(value_key, 0) + change
+
+def get_sibling_step(elem, attrs, position, tag_counts, value_counts):
+    """
+    Returns the XPath step of a child among the siblings present at that moment.
+
+    Args:
+        elem (etree.Element): The child, with the attribute values it has at that moment.
+        attrs (list): Its attributes used for selectors, in the order of preference.
+        position (int): Its position among the preceding siblings with the same tag.
+        tag_counts (dict): Tag to the number of siblings with it.
+        value_counts (dict): (tag, attribute, value) to the number of siblings with it.
+
+    Returns:
+        str: The XPath step.
+    """
+    tag = elem.tag
+    if tag_counts[tag] == 1:
+        return tag
+    for attr in attrs:
+        value = elem.get(attr)
+        if value_counts[(tag, attr, value)] == 1:
+            return f'{tag}[@{attr}={xpath_literal(value)}]'
+    return f'{tag}[{position}]'
+
+def append_operation(diff_root, tag, stream=None, **attrib):
+    """
+    Appends a diff operation.
+    With a stream, the operations appended before are finished, so they are written out first.
+
+    Args:
+        diff_root (etree.Element): Root of the diff XML tree to append the operation to.
+        tag (str): Operation name - 'add', 'replace' or 'remove'.
+        stream (dict): Diff stream opened by open_diff_stream, or None to keep all operations in diff_root.
+        **attrib: Attributes of the operation element, e.g. 'sel' and 'pos'.
+
+    Returns:
+        etree.Element: The appended operation element.
+    """
+    if stream is not None:
+        write_stream_operations(stream, diff_root)
+    return etree.SubElement(diff_root, tag, **attrib)
+
+def add_new_run(diff_root, new_run, sel, pos, stream=None):
+    """
+    Records a run of consecutive new sibling elements as a single 'add' operation.
+
+    Args:
+        diff_root (etree.Element): Root of the diff XML tree to append operations.
+        new_run (list): New elements from the modified XML, in document order.
+        sel (str): Selector of the element of the original XML to anchor the operation on.
+        pos (str): 'before' or 'after' the anchor, or None to append the run to the anchor's children.
+        stream (dict): Diff stream opened by open_diff_stream, or None to keep all operations in diff_root.
+    """
+    if pos:
+        add_op = append_operation(diff_root, 'add', stream=stream, sel=sel, pos=pos)
+    else:
+        add_op = append_operation(diff_root, 'add', stream=stream, sel=sel)
+    for elem in new_run:
+        add_op.append(etree.fromstring(etree.tostring(elem)))
+    logging.debug(f"Marked {len(new_run)} new element(s) for addition {pos or 'into'} '{sel}'.")
 
-def generate_diff(original_tree, modified_tree, indent_str):
+def generate_diff(original_tree, modified_tree, indent_str, key_rules=None, original_key_map=None, jobs=None,
+                  stream=None):
     """
     Generates the diff XML operations between original and modified XML trees.
 
+    With jobs, the changed top-level elements of a large file are split into partitions, which are
+    compared in worker processes. Their operations are merged in document order, so the result
+    is the same as without jobs.
+
+    With a stream, each operation is written out as soon as it is finished, instead of being kept
+    in the returned diff tree.
+
     Args:
         original_tree (etree.ElementTree): Original XML tree.
         modified_tree (etree.ElementTree): Modified XML tree.
         indent_str (str): The detected per-level indentation string.
+        key_rules (dict): Matching keys for the file, as returned by select_key_rules. Defaults to the generic ones.
+        original_key_map (dict): Precomputed key map of the original XML tree, built if not provided.
+        jobs (int): Number of worker processes for large files, None or 1 to compare in this process only.
+        stream (dict): Diff stream opened by open_diff_stream, or None to return all operations.
 
     Returns:
-        etree.Element: Root of the diff XML tree.
+        etree.Element: Root of the diff XML tree, without the operations already written to the stream.
     """
     diff_root = etree.Element('diff')
 
-    # Compare the root elements
-    compare_elements(original_tree.getroot(), modified_tree.getroot(), diff_root, indent_str)
+    # Precompute the element keys of both trees once
+    if key_rules is None:
+        key_rules = select_key_rules(DEFAULT_KEY_SCHEMA, '')
+    if original_key_map is None:
+        original_key_map = build_key_map(original_tree.getroot(), key_rules)
+    key_maps = (original_key_map, {'rules': key_rules, 'hashes': {}, 'root': modified_tree.getroot()})
 
+    # Compare the root elements
+    original_root = original_tree.getroot()
+    modified_root = modified_tree.getroot()
+    if not jobs or jobs < 2 or original_root.tag != modified_root.tag:
+        compare_elements(original_root, modified_root, diff_root, indent_str, key_maps=key_maps, stream=stream)
+    else:
+        matched_pairs = []
+        children = compare_elements(original_root, modified_root, diff_root, indent_str, key_maps=key_maps,
+                                    matched_pairs=matched_pairs, stream=stream)
+        if stream is not None:
+            # The operations of the root come first
+            write_stream_operations(stream, diff_root)
+        diff_root.extend(diff_partitions(original_root, matched_pairs, original_key_map, key_maps, indent_str,
+                                         jobs, stream))
+        # The removed and added top-level elements come last
+        append_child_operations(original_root, modified_root, children, diff_root, key_maps, stream)
+
+    if stream is not None:
+        write_stream_operations(stream, diff_root)
     return diff_root
 
+def init_diff_worker(counts, modified_counts):
+    """
+    Prepares a worker process for diff_partition.
+
+    Args:
+        counts (dict): The 'counts' of the original XML tree key map, shared by all partitions.
+        modified_counts (dict): The counts of the attribute values in the whole modified XML tree.
+    """
+    load_lxml()
+    worker_state['counts'] = counts
+    worker_state['modified_counts'] = modified_counts
+
+def diff_partition(original_root_tag, partition, key_rules, indent_str):
+    """
+    Compares a partition of the top-level elements in a worker process.
+
+    The original elements are placed under a root with the same tag, so their selectors are built
+    the same way as in the whole tree, from their precomputed keys and the counts of the whole tree.
+
+    Args:
+        original_root_tag (str): Tag of the original root element.
+        partition (list): (original key map entry, original element, modified element) tuples,
+            the elements are serialized.
+        key_rules (dict): Matching keys for the file, as returned by select_key_rules.
+        indent_str (str): The detected per-level indentation string.
+
+    Returns:
+        bytes: The serialized diff with the operations of the partition.
+    """
+    original_root = etree.Element(original_root_tag)
+    pairs = []
+    for _, original_data, modified_data in partition:
+        original_elem = etree.fromstring(original_data)
+        original_root.append(original_elem)
+        pairs.append((original_elem, etree.fromstring(modified_data)))
+
+    original_key_map = build_key_map(original_root, key_rules)
+    for (entry, _, _), (original_elem, _) in zip(partition, pairs):
+        original_key_map['elements'][original_elem] = entry
+    original_key_map['counts'] = worker_state['counts']
+    key_maps = (original_key_map, {'rules': key_rules, 'hashes': {}, 'counts': worker_state['modified_counts']})
+
+    diff_root = etree.Element('diff')
+    for original_elem, modified_elem in pairs:
+        if subtrees_equal(original_elem, modified_elem, original_key_map['hashes'], key_maps[1]['hashes']):
+            continue
+        compare_elements(original_elem, modified_elem, diff_root, indent_str, key_maps=key_maps)
+    return etree.tostring(diff_root)
+
+def diff_partitions(original_root, matched_pairs, original_key_map, key_maps, indent_str, jobs, stream=None):
+    """
+    Compares the matching top-level elements, splitting the changed ones into partitions for worker processes.
+
+    Args:
+        original_root (etree.Element): The root element of the original XML tree.
+        matched_pairs (list): (original element, modified element) pairs in document order.
+        original_key_map (dict): Precomputed key map of the original XML tree.
+        key_maps (tuple): The key maps prepared by generate_diff.
+        indent_str (str): The detected per-level indentation string.
+        jobs (int): Number of worker processes.
+        stream (dict): Diff stream opened by open_diff_stream, or None to return the operations.
+
+    Returns:
+        list: The operations in document order, without the ones written to the stream.
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    # Verbatim copies are skipped right away, the serialized elements of the others go to the workers
+    changed = []
+    for original_elem, modified_elem in matched_pairs:
+        original_data = etree.tostring(original_elem, with_tail=False)
+        modified_data = etree.tostring(modified_elem, with_tail=False)
+        if original_data != modified_data:
+            changed.append((original_elem, modified_elem, original_data, modified_data))
+
+    if len(changed) < PARALLEL_DIFF_MIN_CHILDREN:
+        # Not worth starting the workers
+        diff_root = etree.Element('diff')
+        for original_elem, modified_elem, _, _ in changed:
+            if subtrees_equal(original_elem, modified_elem, original_key_map['hashes'], key_maps[1]['hashes']):
+                continue
+            compare_elements(original_elem, modified_elem, diff_root, indent_str, key_maps=key_maps,
+                             stream=stream)
+        if stream is not None:
+            write_stream_operations(stream, diff_root)
+            return []
+        return list(diff_root)
+
+    # Several partitions per worker even out the differences in their sizes.
+    # The steps chosen for the top-level elements by compare_elements go with them.
+    original_elements = original_key_map['elements']
+    steps = original_key_map['steps']
+    changed = [((original_elements[original_elem][0], steps.get(original_elem) or original_elements[original_elem][1],
+                 original_elements[original_elem][2]), original_data, modified_data)
+               for original_elem, _, original_data, modified_data in changed]
+    partition_size = -(-len(changed) // (jobs * 4))
+    partitions = [changed[start:start + partition_size] for start in range(0, len(changed), partition_size)]
+    logging.info(f"Comparing {len(changed)} changed top-level elements in {len(partitions)} partitions.")
+    # The prefetch reader and writer threads may be running, a fork could copy the locks they hold
+    start_methods = multiprocessing.get_all_start_methods()
+    mp_context = multiprocessing.get_context('forkserver' if 'forkserver' in start_methods else 'spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context, initializer=init_diff_worker,
+                                                initargs=(original_key_map['counts'],
+                                                          get_modified_counts(key_maps[1]))) as executor:
+        results = executor.map(diff_partition, [original_root.tag] * len(partitions), partitions,
+                               [key_maps[1]['rules']] * len(partitions), [indent_str] * len(partitions))
+
+        operations = []
+        for partition_diff in results:
+            if stream is not None:
+                # Written as soon as the partition is done, the following ones are still being compared
+                write_stream_operations(stream, etree.fromstring(partition_diff))
+            else:
+                operations.extend(etree.fromstring(partition_diff))
+    return operations
+
+def apply_diff_in_memory(original_tree, diff_root):
+    """
+    Applies the diff operations to a copy of the original XML tree with the same code as xml-patch.py.
+
+    Args:
+        original_tree (etree.ElementTree): Original XML tree, left unchanged.
+        diff_root (etree.Element): Root of the diff XML tree.
+
+    Returns:
+        tuple: The patched copy of the tree and a list of problems met while applying the operations.
+    """
+    patched_tree = copy.deepcopy(original_tree)
+    patched_root = patched_tree.getroot()
+    problems = []
+    # The patch code logs every change, only the problems are of interest here
+    logging.disable(logging.WARNING)
+    try:
+        for operation in diff_root:
+            if not isinstance(operation.tag, str):
+                continue
+            sel = operation.get('sel')
+            try:
+                target_nodes = resolve_selector(sel, patched_root)
+            except etree.XPathError as e:
+                problems.append(f"Invalid selector in '{operation.tag}': {sel} ({e})")
+                continue
+            if not target_nodes:
+                problems.append(f"No nodes found for '{operation.tag}' selector: {sel}")
+                continue
+            if len(target_nodes) > 1:
+                problems.append(f"{len(target_nodes)} nodes found for '{operation.tag}' selector: {sel}")
+            if apply_operation(operation, patched_root, target_nodes) is None:
+                problems.append(f"Unknown operation: {operation.tag}")
+    finally:
+        logging.disable(logging.NOTSET)
+    return patched_tree, problems
+
+def find_mismatches(patched_elem, modified_elem, patched_hashes, modified_hashes):
+    """
+    Finds the elements where the patched XML tree differs from the modified one,
+    descending only into the subtrees whose canonical hashes differ.
+
+    Args:
+        patched_elem (etree.Element): Element from the patched XML.
+        modified_elem (etree.Element): Element from the modified XML.
+        patched_hashes (dict): Subtree digests of the patched XML, updated in place.
+        modified_hashes (dict): Subtree digests of the modified XML, updated in place.
+
+    Returns:
+        list: Descriptions of the mismatches, with paths in the modified XML.
+    """
+    if get_subtree_hash(patched_elem, patched_hashes) == get_subtree_hash(modified_elem, modified_hashes):
+        return []
+
+    path = modified_elem.getroottree().getpath(modified_elem)
+    if patched_elem.tag != modified_elem.tag:
+        return [f"{path}: element '{patched_elem.tag}' instead of '{modified_elem.tag}'"]
+
+    mismatches = []
+    if dict(patched_elem.attrib) != dict(modified_elem.attrib):
+        mismatches.append(f"{path}: attributes differ")
+    patched_text = patched_elem.text.strip() if patched_elem.text else ''
+    modified_text = modified_elem.text.strip() if modified_elem.text else ''
+    if patched_text != modified_text:
+        mismatches.append(f"{path}: text differs")
+
+    patched_children = list(patched_elem.iterchildren(etree.Element))
+    modified_children = list(modified_elem.iterchildren(etree.Element))
+    if [child.tag for child in patched_children] != [child.tag for child in modified_children]:
+        mismatches.append(f"{path}: child elements differ")
+        return mismatches
+    for patched_child, modified_child in zip(patched_children, modified_children):
+        mismatches.extend(find_mismatches(patched_child, modified_child, patched_hashes, modified_hashes))
+    return mismatches
+
+def verify_diff(original_tree, modified_tree, diff_root):
+    """
+    Verifies the diff by applying it to an in-memory copy of the original XML tree
+    and comparing the result with the modified XML tree.
+
+    Args:
+        original_tree (etree.ElementTree): Original XML tree.
+        modified_tree (etree.ElementTree): Modified XML tree.
+        diff_root (etree.Element): Root of the diff XML tree.
+
+    Returns:
+        list: Problems found, empty if the diff reproduces the modified XML.
+    """
+    patched_tree, problems = apply_diff_in_memory(original_tree, diff_root)
+    problems.extend(find_mismatches(patched_tree.getroot(), modified_tree.getroot(), {}, {}))
+    return problems
+
+def iterate_element_events(xml_path):
+    """
+    Streams the 'start' and 'end' events of the elements of an XML file, releasing the processed
+    elements, so the memory use does not grow with the file size.
+
+    Args:
+        xml_path (str): Path to the XML file.
+
+    Yields:
+        tuple: The event name and the element.
+    """
+    for event, elem in etree.iterparse(xml_path, events=('start', 'end'), remove_comments=True, remove_pis=True):
+        yield event, elem
+        if event == 'end':
+            # Release the processed element and its already processed siblings
+            elem.clear(keep_tail=True)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+def check_equivalence(original_xml_path, modified_xml_path):
+    """
+    Checks whether two XML files are semantically equal, ignoring whitespace around text, tails,
+    attribute order, comments and processing instructions. Both files are streamed in step and
+    the check stops at the first difference, without building any diff.
+
+    Args:
+        original_xml_path (str): Path to the original XML file.
+        modified_xml_path (str): Path to the modified XML file.
+
+    Returns:
+        str: Description of the first difference with its location, or None if the files are equal.
+    """
+    path = []
+    position_counters = [{}]
+    original_events = iterate_element_events(original_xml_path)
+    modified_events = iterate_element_events(modified_xml_path)
+    while True:
+        original_event = next(original_events, None)
+        modified_event = next(modified_events, None)
+        if original_event is None or modified_event is None:
+            if original_event is modified_event:
+                return None
+            return f"{''.join(path) or '/'}: {'modified' if original_event is None else 'original'} XML has more content"
+
+        (event, original_elem), (modified_event_name, modified_elem) = original_event, modified_event
+        if event == 'start':
+            counters = position_counters[-1]
+            counters[original_elem.tag] = counters.get(original_elem.tag, 0) + 1
+            path.append(f'/{original_elem.tag}[{counters[original_elem.tag]}]')
+            position_counters.append({})
+        location = f"{''.join(path)} (lines {original_elem.sourceline} and {modified_elem.sourceline})"
+
+        if event != modified_event_name:
+            return f"{location}: child elements differ"
+        if event == 'start':
+            if original_elem.tag != modified_elem.tag:
+                return f"{location}: element '{original_elem.tag}' replaced by '{modified_elem.tag}'"
+            if dict(original_elem.attrib) != dict(modified_elem.attrib):
+                return f"{location}: attributes differ"
+        else:
+            original_text = original_elem.text.strip() if original_elem.text else ''
+            modified_text = modified_elem.text.strip() if modified_elem.text else ''
+            if original_text != modified_text:
+                return f"{location}: text differs"
+            path.pop()
+            position_counters.pop()
+
+def check_file_pair(original_xml_path, modified_xml_path):
+    """
+    Runs the equivalence check for a pair of files, catching the errors, so it can run in a worker process.
+
+    Args:
+        original_xml_path (str): Path to the original XML file.
+        modified_xml_path (str): Path to the modified XML file.
+
+    Returns:
+        tuple: True if the files are equal, False if they differ, None on error; and the message.
+    """
+    if not os.path.isfile(original_xml_path):
+        # A file added by the mod is a difference, not an error
+        if os.path.isfile(modified_xml_path):
+            return False, f"Original XML file does not exist: {original_xml_path}"
+        return None, f"Original XML file does not exist: {original_xml_path}"
+    if not os.path.isfile(modified_xml_path):
+        return False, f"Modified XML file does not exist: {modified_xml_path}"
+    try:
+        # Identical files need no parsing at all
+        if filecmp.cmp(original_xml_path, modified_xml_path, shallow=False):
+            return True, None
+        difference = check_equivalence(original_xml_path, modified_xml_path)
+    except Exception as e:
+        return None, f"Error checking '{modified_xml_path}': {e}"
+    if difference:
+        return False, difference
+    return True, None
+
+def check_directories(original_dir, modified_dir, jobs=None):
+    """
+    Checks recursively whether all XML files of two directories are semantically equal, in parallel processes.
+
+    Args:
+        original_dir (str): Path to the original XML directory.
+        modified_dir (str): Path to the modified XML directory.
+        jobs (int): Number of worker processes, defaults to the number of CPUs.
+
+    Returns:
+        tuple: Numbers of different files and of files that could not be checked.
+    """
+    import concurrent.futures
+
+    relative_paths = set()
+    for base_dir in (original_dir, modified_dir):
+        for root, _, files in os.walk(base_dir):
+            for file in files:
+                if file.lower().endswith('.xml'):
+                    relative_paths.add(os.path.relpath(os.path.join(root, file), base_dir))
+
+    differences = 0
+    errors = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=load_lxml) as executor:
+        futures = {
+            executor.submit(check_file_pair, os.path.join(original_dir, relative_path),
+                            os.path.join(modified_dir, relative_path)): relative_path
+            for relative_path in sorted(relative_paths)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            relative_path = futures[future]
+            equal, message = future.result()
+            if equal:
+                logging.debug(f"Equal: {relative_path}")
+            elif equal is False:
+                differences += 1
+                logging.error(f"Different: {relative_path}: {message}")
+            else:
+                errors += 1
+                logging.error(message)
+    logging.info(f"Checked {len(relative_paths)} file(s): {differences} different, {errors} failed.")
+    return differences, errors
+
 def validate_diff_xml(diff_xml_path, xsd_path):
     """
     Validates the generated diff XML against the provided XSD schema.
@@ -341,86 +1111,265 @@ def validate_diff_xml(diff_xml_path, xsd_path):
         xsd_path (str): Path to the XSD schema file.
     """
     try:
-        with open(xsd_path, 'rb') as f:
-            xmlschema_doc = etree.parse(f)
-            xmlschema = etree.XMLSchema(xmlschema_doc)
+        with open(diff_xml_path, 'rb') as f:
+            xml_doc = etree.parse(f)
     except Exception as e:
-        logging.error(f"Error parsing XSD: {e}")
+        logging.error(f"Error parsing diff XML: {e}")
         return
 
+    validate_diff_tree(xml_doc, diff_xml_path, xsd_path)
+
+def validate_diff_tree(xml_doc, diff_xml_name, xsd_path):
+    """
+    Validates the diff XML tree against the provided XSD schema.
+
+    Args:
+        xml_doc (etree.ElementTree): The diff XML tree.
+        diff_xml_name (str): Path or archive entry name of the diff XML, for the messages.
+        xsd_path (str): Path to the XSD schema file.
+    """
     try:
-        with open(diff_xml_path, 'rb') as f:
-            xml_doc = etree.parse(f)
+        xmlschema = load_xml_schema(xsd_path)
     except Exception as e:
-        logging.error(f"Error parsing diff XML: {e}")
+        logging.error(f"Error parsing XSD: {e}")
         return
 
     if xmlschema.validate(xml_doc):
-        logging.info(f"Validation successful: {diff_xml_path} is valid against {xsd_path}")
+        logging.info(f"Validation successful: {diff_xml_name} is valid against {xsd_path}")
     else:
-        logging.error(f"Validation failed: {diff_xml_path} is not valid against {xsd_path}")
+        logging.error(f"Validation failed: {diff_xml_name} is not valid against {xsd_path}")
         for error in xmlschema.error_log:
             logging.error(error.message)
         return
 
-def process_single_file(original_xml_path, modified_xml_path, diff_xml_path, diff_xsd_path):
+def is_archive_path(path):
     """
-    Processes a single trio of original, modified, and diff XML files.
+    Checks whether the output path is an archive to pack the diffs into.
 
     Args:
-        original_xml_path (str): Path to the original XML file.
-        modified_xml_path (str): Path to the modified XML file.
-        diff_xml_path (str): Path for the output diff XML file or directory.
-        diff_xsd_path (str): Path to the diff.xsd schema file.
+        path (str): The output path.
+
+    Returns:
+        bool: True for '.zip', '.tar', '.tar.gz' and '.tgz' paths.
     """
-    # Check if original XML file exists
-    if not os.path.isfile(original_xml_path):
-        logging.error(f"Original XML file does not exist: {original_xml_path}")
-        return
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
 
-    # Check if modified XML file exists
-    if not os.path.isfile(modified_xml_path):
-        logging.error(f"Modified XML file does not exist: {modified_xml_path}")
+def open_archive(archive_path):
+    """
+    Opens the output archive for writing, the format is chosen by the file extension.
+
+    Args:
+        archive_path (str): Path to the archive.
+
+    Returns:
+        zipfile.ZipFile or tarfile.TarFile: The opened archive.
+    """
+    import gzip
+    import tarfile
+    import zipfile
+
+    lower_path = archive_path.lower()
+    if lower_path.endswith('.zip'):
+        return zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED)
+    if lower_path.endswith('.tar'):
+        return tarfile.open(archive_path, 'w', format=tarfile.PAX_FORMAT)
+    # A fixed timestamp in the gzip header keeps the archive reproducible
+    return tarfile.open(fileobj=gzip.GzipFile(archive_path, 'wb', mtime=0), mode='w', format=tarfile.PAX_FORMAT)
+
+def close_archive(archive):
+    """
+    Finishes and closes the output archive.
+
+    Args:
+        archive (zipfile.ZipFile or tarfile.TarFile): The archive opened by open_archive.
+    """
+    import tarfile
+
+    archive.close()
+    # tarfile does not close a file object it was given
+    if isinstance(archive, tarfile.TarFile) and not archive.fileobj.closed:
+        archive.fileobj.close()
+
+def add_archive_entry(archive, entry_name, data):
+    """
+    Adds a file to the output archive. Timestamps and permissions are fixed,
+    so the same diffs always produce the same archive.
+
+    Args:
+        archive (zipfile.ZipFile or tarfile.TarFile): The archive opened by open_archive.
+        entry_name (str): Path of the file inside the archive, with '/' separators.
+        data (bytes): Content of the file.
+    """
+    import io
+    import tarfile
+    import zipfile
+
+    if isinstance(archive, zipfile.ZipFile):
+        info = zipfile.ZipInfo(entry_name, date_time=(1980, 1, 1, 0, 0, 0))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        archive.writestr(info, data)
+    else:
+        info = tarfile.TarInfo(entry_name)
+        info.size = len(data)
+        info.mtime = 0
+        info.mode = 0o644
+        archive.addfile(info, io.BytesIO(data))
+
+def write_diff_to_archive(diff_tree_root, archive, entry_name, indent_str, diff_xsd_path):
+    """
+    Indents and serializes the diff XML into the output archive, then validates it against diff.xsd if available.
+
+    Args:
+        diff_tree_root (etree.Element): Root of the diff XML tree.
+        archive (zipfile.ZipFile or tarfile.TarFile): The archive opened by open_archive.
+        entry_name (str): Path of the diff inside the archive, with '/' separators.
+        indent_str (str): The detected per-level indentation string.
+        diff_xsd_path (str): Path to the diff.xsd schema file.
+    """
+    diff_tree = etree.ElementTree(diff_tree_root)
+    if hasattr(etree, 'indent'):
+        etree.indent(diff_tree, space=indent_str)
+    try:
+        add_archive_entry(archive, entry_name,
+                          etree.tostring(diff_tree, pretty_print=True, xml_declaration=True, encoding='UTF-8'))
+        logging.info(f"Diff XML written to archive as {entry_name}")
+    except Exception as e:
+        logging.error(f"Error writing diff XML '{entry_name}' to archive: {e}")
         return
 
-    # Check if diff_xml is a directory
-    if os.path.isdir(diff_xml_path):
-        original_filename = os.path.basename(original_xml_path)
-        diff_xml_path = os.path.join(diff_xml_path, original_filename)
-        logging.info(f"Diff XML will be saved as: {diff_xml_path}")
+    if diff_xsd_path:
+        validate_diff_tree(diff_tree, entry_name, diff_xsd_path)
     else:
-        # Ensure the output directory exists
-        diff_xml_dir = os.path.dirname(diff_xml_path)
-        if diff_xml_dir and not os.path.exists(diff_xml_dir):
-            try:
-                os.makedirs(diff_xml_dir)
-                logging.info(f"Created output directory: {diff_xml_dir}")
-            except Exception as e:
-                logging.error(f"Failed to create output directory '{diff_xml_dir}': {e}")
-                return
+        logging.info("Skipping validation as diff.xsd was not provided or found.")
+
+def read_file_pair(original_xml_path, modified_xml_path, key_schema=None, cache_dir=None):
+    """
+    Reads and parses the original and modified XML files and looks up the cached indexes of the original one.
+    There is nothing but I/O and parsing, so it can run in a reader thread.
+
+    Args:
+        original_xml_path (str): Path to the original XML file.
+        modified_xml_path (str): Path to the modified XML file.
+        key_schema (list): Matching keys as returned by load_key_schema. Defaults to the built-in ones.
+        cache_dir (str): Path to the cache directory for indexes of original XML files, or None to disable it.
 
-    # Load both XML files
+    Returns:
+        tuple: The original tree, its cache entry and entry path, the key rules and the modified tree; or None on error.
+    """
+    key_rules = select_key_rules(key_schema or DEFAULT_KEY_SCHEMA, original_xml_path)
     try:
-        original_tree = etree.parse(original_xml_path)
+        original_tree, entry, entry_path = read_original_xml(original_xml_path, key_rules, cache_dir)
         logging.info(f"Parsed original XML: {original_xml_path}")
     except Exception as e:
         logging.error(f"Error parsing original XML: {e}")
-        return
+        return None
 
     try:
         modified_tree = etree.parse(modified_xml_path)
         logging.info(f"Parsed modified XML: {modified_xml_path}")
     except Exception as e:
         logging.error(f"Error parsing modified XML: {e}")
-        return
+        return None
 
-    # Detect indentation from original XML
-    indent_str = detect_indentation(original_xml_path)
-    logging.info(f"Detected indentation: '{repr(indent_str)}'")
+    return original_tree, entry, entry_path, key_rules, modified_tree
 
-    # Generate the diff XML
-    diff_tree_root = generate_diff(original_tree, modified_tree, indent_str)
+def open_diff_stream(diff_xml_path, indent_str):
+    """
+    Opens the diff XML file for writing the operations one by one, as soon as they are generated.
+    The output is the same as the one of write_diff_xml. It is written to a temporary file next to
+    the diff XML file, which replaces it in close_diff_stream, so a failed run leaves no partial diff.
+
+    Args:
+        diff_xml_path (str): Path for the output diff XML file.
+        indent_str (str): The detected per-level indentation string.
+
+    Returns:
+        dict: The stream state, for write_stream_operations and close_diff_stream.
+    """
+    temp_path = f"{diff_xml_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    resources = contextlib.ExitStack()
+    try:
+        output = resources.enter_context(open(temp_path, 'wb'))
+        # The final line break follows the closed root element, as in the files written by write_diff_xml
+        resources.callback(output.write, b'\n')
+        xml_file = resources.enter_context(etree.xmlfile(output, encoding='UTF-8'))
+        xml_file.write_declaration()
+    except BaseException:
+        resources.close()
+        remove_temp_file(temp_path)
+        raise
+    return {'resources': resources, 'file': xml_file, 'root': False, 'indent': indent_str,
+            'written': 0, 'path': diff_xml_path, 'temp_path': temp_path}
+
+def write_stream_operations(stream, diff_root):
+    """
+    Writes the finished operations to the diff stream and removes them from diff_root.
+
+    Args:
+        stream (dict): Diff stream opened by open_diff_stream.
+        diff_root (etree.Element): Root of the diff XML tree holding the finished operations.
+    """
+    xml_file = stream['file']
+    for operation in diff_root:
+        if not stream['root']:
+            stream['resources'].enter_context(xml_file.element('diff'))
+            stream['root'] = True
+        if hasattr(etree, 'indent'):
+            etree.indent(operation, space=stream['indent'], level=1)
+            xml_file.write('\n' + stream['indent'])
+        operation.tail = None
+        xml_file.write(operation)
+        stream['written'] += 1
+    del diff_root[:]
+
+def close_diff_stream(stream, discard=False):
+    """
+    Finishes and closes the diff XML file of the stream, then moves it in place of the diff XML file.
+
+    Args:
+        stream (dict): Diff stream opened by open_diff_stream.
+        discard (bool): Remove the written operations instead, e.g. when the diff generation failed.
+    """
+    try:
+        try:
+            if not discard:
+                if not stream['root']:
+                    stream['file'].write(etree.Element('diff'))
+                elif hasattr(etree, 'indent'):
+                    stream['file'].write('\n')
+        finally:
+            stream['resources'].close()
+        if not discard:
+            os.replace(stream['temp_path'], stream['path'])
+    finally:
+        # Left over only if discarded or if finishing it failed
+        remove_temp_file(stream['temp_path'])
+
+def remove_temp_file(temp_path):
+    """
+    Removes a temporary output file, if it exists.
 
+    Args:
+        temp_path (str): Path to the temporary file.
+    """
+    try:
+        os.remove(temp_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.warning(f"Failed to remove temporary file '{temp_path}': {e}")
+
+def write_diff_xml(diff_tree_root, diff_xml_path, indent_str, diff_xsd_path):
+    """
+    Indents and writes the diff XML, then validates it against diff.xsd if available.
+
+    Args:
+        diff_tree_root (etree.Element): Root of the diff XML tree.
+        diff_xml_path (str): Path for the output diff XML file.
+        indent_str (str): The detected per-level indentation string.
+        diff_xsd_path (str): Path to the diff.xsd schema file.
+    """
     # Create an ElementTree for diff
     diff_tree = etree.ElementTree(diff_tree_root)
 
@@ -441,16 +1390,158 @@ def process_single_file(original_xml_path, modified_xml_path, diff_xml_path, dif
     else:
         logging.info("Skipping validation as diff.xsd was not provided or found.")
 
-def process_directories(original_dir, modified_dir, diff_dir, xsd_path):
+def process_single_file(original_xml_path, modified_xml_path, diff_xml_path, diff_xsd_path, key_schema=None,
+                        cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, verify=False, loaded=None, write_queue=None,
+                        archive=None, jobs=None):
+    """
+    Processes a single trio of original, modified, and diff XML files.
+
+    Args:
+        original_xml_path (str): Path to the original XML file.
+        modified_xml_path (str): Path to the modified XML file.
+        diff_xml_path (str): Path for the output diff XML file or directory, or the entry name inside the archive.
+        diff_xsd_path (str): Path to the diff.xsd schema file.
+        key_schema (list): Matching keys as returned by load_key_schema. Defaults to the built-in ones.
+        cache_dir (str): Path to the cache directory for indexes of original XML files, or None to disable it.
+        cache_size (int): Maximum total size of the cache directory in bytes.
+        verify (bool): Verify the generated diff reproduces the modified XML when applied to the original one.
+        loaded (concurrent.futures.Future): Prefetched result of read_file_pair, the files are read here if not provided.
+        write_queue (queue.Queue): Queue of the writer thread, the diff is written here if not provided.
+        archive (zipfile.ZipFile or tarfile.TarFile): Output archive, diffs without operations are left out of it.
+        jobs (int): Number of worker processes for comparing a large file, None to compare it in this process.
+
+    Returns:
+        bool: The verification result if requested and the diff was generated, None otherwise.
+    """
+    # Check if original XML file exists
+    if not os.path.isfile(original_xml_path):
+        logging.error(f"Original XML file does not exist: {original_xml_path}")
+        return
+
+    # Check if modified XML file exists
+    if not os.path.isfile(modified_xml_path):
+        logging.error(f"Modified XML file does not exist: {modified_xml_path}")
+        return
+
+    # Check if diff_xml is a directory
+    if archive is not None:
+        pass
+    elif os.path.isdir(diff_xml_path):
+        original_filename = os.path.basename(original_xml_path)
+        diff_xml_path = os.path.join(diff_xml_path, original_filename)
+        logging.info(f"Diff XML will be saved as: {diff_xml_path}")
+    else:
+        # Ensure the output directory exists
+        diff_xml_dir = os.path.dirname(diff_xml_path)
+        if diff_xml_dir and not os.path.exists(diff_xml_dir):
+            try:
+                os.makedirs(diff_xml_dir)
+                logging.info(f"Created output directory: {diff_xml_dir}")
+            except Exception as e:
+                logging.error(f"Failed to create output directory '{diff_xml_dir}': {e}")
+                return
+
+    # Load both XML files, the original one together with its indexes
+    if loaded is not None:
+        loaded = loaded.result()
+    else:
+        loaded = read_file_pair(original_xml_path, modified_xml_path, key_schema, cache_dir)
+    if loaded is None:
+        return
+    original_tree, entry, entry_path, key_rules, modified_tree = loaded
+    indent_str, original_key_map = index_original_xml(original_tree, original_xml_path, key_rules, entry, entry_path,
+                                                      cache_size)
+    logging.info(f"Detected indentation: '{repr(indent_str)}'")
+
+    # Without verification the operations are written as soon as they are generated,
+    # so the diff tree is never held in memory as a whole. With a writer thread the whole tree
+    # is kept instead, so the writing goes on in parallel with comparing the next files.
+    if archive is None and not verify and write_queue is None:
+        try:
+            stream = open_diff_stream(diff_xml_path, indent_str)
+        except Exception as e:
+            logging.error(f"Error writing diff XML: {e}")
+            return
+        try:
+            generate_diff(original_tree, modified_tree, indent_str, key_rules, original_key_map, jobs, stream)
+        except BaseException:
+            close_diff_stream(stream, discard=True)
+            raise
+        try:
+            close_diff_stream(stream)
+        except Exception as e:
+            logging.error(f"Error writing diff XML: {e}")
+            return
+        logging.info(f"Diff XML written to {diff_xml_path} ({stream['written']} operation(s))")
+
+        # Validate the diff XML against diff.xsd if available
+        if diff_xsd_path:
+            validate_diff_xml(diff_xml_path, diff_xsd_path)
+        else:
+            logging.info("Skipping validation as diff.xsd was not provided or found.")
+        return
+
+    # Generate the diff XML
+    diff_tree_root = generate_diff(original_tree, modified_tree, indent_str, key_rules, original_key_map, jobs)
+
+    # Verify the diff in memory, before it is re-indented
+    verified = None
+    if verify:
+        problems = verify_diff(original_tree, modified_tree, diff_tree_root)
+        verified = not problems
+        if verified:
+            logging.info(f"Verification passed: {modified_xml_path}")
+        else:
+            logging.error(f"Verification failed: {modified_xml_path}")
+            for problem in problems:
+                logging.error(f"  {problem}")
+
+    # Indent, write and validate the diff XML
+    if archive is not None:
+        if len(diff_tree_root) == 0:
+            logging.info(f"No changes, leaving {diff_xml_path} out of the archive.")
+            return verified
+        write_function, write_arguments = write_diff_to_archive, (diff_tree_root, archive, diff_xml_path, indent_str,
+                                                                 diff_xsd_path)
+    else:
+        write_function, write_arguments = write_diff_xml, (diff_tree_root, diff_xml_path, indent_str, diff_xsd_path)
+    if write_queue is not None:
+        write_queue.put((write_function, write_arguments))
+    else:
+        write_function(*write_arguments)
+
+    return verified
+
+def process_directories(original_dir, modified_dir, diff_dir, xsd_path, key_schema=None,
+                        cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, verify=False, prefetch=0, archive_path=None,
+                        jobs=None):
     """
     Processes directories by recursively generating diffs for each XML file.
 
+    With prefetch, reader threads parse the next file pairs and a writer thread writes the finished
+    diffs while the current one is computed, with bounded queues keeping the memory use in check.
+
+    With archive_path, the diffs are streamed into a single archive as they are generated. The files are
+    processed in sorted order so the same inputs always give the same archive, and files without any
+    changes are left out.
+
     Args:
         original_dir (str): Path to the original XML directory.
         modified_dir (str): Path to the modified XML directory.
         diff_dir (str): Path for the output diff XML directory.
         xsd_path (str): Path to the diff.xsd schema file.
+        key_schema (list): Matching keys as returned by load_key_schema. Defaults to the built-in ones.
+        cache_dir (str): Path to the cache directory for indexes of original XML files, or None to disable it.
+        cache_size (int): Maximum total size of the cache directory in bytes.
+        verify (bool): Verify each generated diff and report the results per file.
+        prefetch (int): Number of file pairs to read ahead, 0 to process the files one by one.
+        archive_path (str): Path for the output archive, replaces diff_dir when given.
+        jobs (int): Number of worker processes for comparing a large file, None to compare it in this process.
+
+    Returns:
+        bool: False if the verification of any file failed, True otherwise.
     """
+    trios = []
     for root, _, files in os.walk(original_dir):
         for file in files:
             if file.lower().endswith('.xml'):
@@ -458,14 +1549,20 @@ def process_directories(original_dir, modified_dir, diff_dir, xsd_path):
                 # Determine the relative path
                 relative_path = os.path.relpath(original_file_path, original_dir)
                 modified_file_path = os.path.join(modified_dir, relative_path)
-                diff_file_path = os.path.join(diff_dir, relative_path)
 
                 # Ensure the modified file exists
                 if not os.path.isfile(modified_file_path):
                     logging.warning(f"Modified file does not exist: {modified_file_path}. Skipping.")
                     continue
 
+                if archive_path:
+                    # Archive entries always use '/' separators
+                    trios.append((relative_path, original_file_path, modified_file_path,
+                                  relative_path.replace(os.sep, '/')))
+                    continue
+
                 # Ensure the output directory exists
+                diff_file_path = os.path.join(diff_dir, relative_path)
                 diff_file_dir = os.path.dirname(diff_file_path)
                 if not os.path.exists(diff_file_dir):
                     try:
@@ -475,9 +1572,129 @@ def process_directories(original_dir, modified_dir, diff_dir, xsd_path):
                         logging.error(f"Failed to create directory '{diff_file_dir}': {e}")
                         continue
 
-                # Process the single file trio
-                process_single_file(original_file_path, modified_file_path, diff_file_path, xsd_path)
+                trios.append((relative_path, original_file_path, modified_file_path, diff_file_path))
+
+    archive = None
+    if archive_path:
+        trios.sort(key=lambda trio: trio[3])
+        try:
+            archive_dir = os.path.dirname(archive_path)
+            if archive_dir and not os.path.exists(archive_dir):
+                os.makedirs(archive_dir)
+            archive = open_archive(archive_path)
+        except Exception as e:
+            logging.error(f"Failed to create archive '{archive_path}': {e}")
+            return False
+
+    try:
+        verification_results = process_trios(trios, xsd_path, key_schema, cache_dir, cache_size, verify, prefetch,
+                                             archive, jobs)
+    finally:
+        if archive is not None:
+            close_archive(archive)
+            logging.info(f"Archive written: {archive_path}")
+
+    if verify:
+        logging.info("Verification results:")
+        for relative_path, verified in verification_results:
+            status = 'PASS' if verified else 'FAIL' if verified is False else 'ERROR'
+            logging.info(f"  {status} {relative_path}")
+    return all(verified for _, verified in verification_results)
+
+def process_trios(trios, xsd_path, key_schema=None, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, verify=False,
+                  prefetch=0, archive=None, jobs=None):
+    """
+    Generates the diffs of the collected file trios, one by one or pipelined.
+
+    Args:
+        trios (list): (relative path, original path, modified path, diff path or archive entry name) tuples.
+        xsd_path (str): Path to the diff.xsd schema file.
+        key_schema (list): Matching keys as returned by load_key_schema. Defaults to the built-in ones.
+        cache_dir (str): Path to the cache directory for indexes of original XML files, or None to disable it.
+        cache_size (int): Maximum total size of the cache directory in bytes.
+        verify (bool): Verify each generated diff.
+        prefetch (int): Number of file pairs to read ahead, 0 to process the files one by one.
+        archive (zipfile.ZipFile or tarfile.TarFile): Output archive, or None to write the diffs as files.
+        jobs (int): Number of worker processes for comparing a large file, None to compare it in this process.
+
+    Returns:
+        list: (relative path, verification result) pairs when verify is set.
+    """
+    import concurrent.futures
+
+    verification_results = []
+    if prefetch > 0:
+        write_queue = queue.Queue(maxsize=prefetch)
+        writer = threading.Thread(target=run_writer, args=(write_queue,), name='writer')
+        writer.start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix='reader') as readers:
+                loads = collections.deque()
+                for index, (relative_path, original_file_path, modified_file_path, diff_file_path) in enumerate(trios):
+                    # Keep the next file pairs loading while the current one is processed
+                    for _, next_original, next_modified, _ in trios[index + len(loads):index + prefetch + 1]:
+                        loads.append(readers.submit(read_file_pair, next_original, next_modified, key_schema, cache_dir))
+                    verified = process_single_file(original_file_path, modified_file_path, diff_file_path, xsd_path,
+                                                   key_schema, cache_dir, cache_size, verify,
+                                                   loaded=loads.popleft(), write_queue=write_queue, archive=archive,
+                                                   jobs=jobs)
+                    if verify:
+                        verification_results.append((relative_path, verified))
+        finally:
+            write_queue.put(None)
+            writer.join()
+    else:
+        for relative_path, original_file_path, modified_file_path, diff_file_path in trios:
+            # Process the single file trio
+            verified = process_single_file(original_file_path, modified_file_path, diff_file_path, xsd_path,
+                                           key_schema, cache_dir, cache_size, verify, archive=archive, jobs=jobs)
+            if verify:
+                verification_results.append((relative_path, verified))
+    return verification_results
+
 
+def run_diff_job(original_xml_path, modified_xml_path, diff_xml_path, diff_xsd_path, key_schema=None,
+                 cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, verify=False, prefetch=0, jobs=None):
+    """
+    Generates the diff of a pair of files or directories, depending on the given paths.
+
+    Args:
+        original_xml_path (str): Path to the original XML file or directory.
+        modified_xml_path (str): Path to the modified XML file or directory.
+        diff_xml_path (str): Path for the output diff XML file, directory or archive.
+        diff_xsd_path (str): Path to the diff.xsd schema file.
+        key_schema (list): Matching keys as returned by load_key_schema. Defaults to the built-in ones.
+        cache_dir (str): Path to the cache directory for indexes of original XML files, or None to disable it.
+        cache_size (int): Maximum total size of the cache directory in bytes.
+        verify (bool): Verify each generated diff.
+        prefetch (int): Number of file pairs to read ahead in directories, 0 to process the files one by one.
+        jobs (int): Number of worker processes for comparing a large file, None to compare it in this process.
+
+    Returns:
+        bool: False if the paths do not match or the verification failed, True otherwise.
+    """
+    # Determine if input paths are files or directories
+    original_is_dir = os.path.isdir(original_xml_path)
+    modified_is_dir = os.path.isdir(modified_xml_path)
+    diff_is_dir = os.path.isdir(diff_xml_path)
+
+    if original_is_dir and modified_is_dir and not diff_is_dir and is_archive_path(diff_xml_path):
+        logging.info(f"Processing directories recursively into archive {diff_xml_path}.")
+        verified = process_directories(original_xml_path, modified_xml_path, None, diff_xsd_path, key_schema,
+                                       cache_dir, cache_size, verify, prefetch, archive_path=diff_xml_path, jobs=jobs)
+    elif original_is_dir and modified_is_dir and diff_is_dir:
+        logging.info("Processing directories recursively.")
+        verified = process_directories(original_xml_path, modified_xml_path, diff_xml_path, diff_xsd_path, key_schema,
+                                       cache_dir, cache_size, verify, prefetch, jobs=jobs)
+    elif not original_is_dir and not modified_is_dir:
+        logging.info("Processing single trio of files.")
+        verified = process_single_file(original_xml_path, modified_xml_path, diff_xml_path, diff_xsd_path, key_schema,
+                                       cache_dir, cache_size, verify, jobs=jobs)
+    else:
+        logging.error("Mismatch in input paths. Original and modified paths should be directories or both should be files.")
+        return False
+
+    return not verify or bool(verified)
 
 def main():
     logging.basicConfig(
@@ -488,7 +1705,28 @@ def main():
         ]
     )
 
-    original_xml_path, modified_xml_path, diff_xml_path, diff_xsd_path = parse_arguments()
+    (original_xml_path, modified_xml_path, diff_xml_path, diff_xsd_path, keys_json_path,
+     cache_dir, cache_size, verify, check, jobs, prefetch, batch_path) = parse_arguments()
+    load_lxml()
+
+    # The equivalence check needs neither diff.xsd nor an output path
+    if check and batch_path:
+        logging.error("The --check option cannot be used with --batch.")
+        sys.exit(2)
+    if check:
+        if os.path.isdir(original_xml_path) and os.path.isdir(modified_xml_path):
+            differences, errors = check_directories(original_xml_path, modified_xml_path, jobs)
+        elif not os.path.isdir(original_xml_path) and not os.path.isdir(modified_xml_path):
+            equal, message = check_file_pair(original_xml_path, modified_xml_path)
+            differences, errors = int(equal is False), int(equal is None)
+            if equal:
+                logging.info(f"Files are equal: {original_xml_path} and {modified_xml_path}")
+            else:
+                logging.error(message)
+        else:
+            logging.error("Mismatch in input paths. Original and modified paths should be directories or both should be files.")
+            sys.exit(2)
+        sys.exit(2 if errors else 1 if differences else 0)
 
     # Determine the path to diff.xsd
     if diff_xsd_path:
@@ -508,20 +1746,33 @@ def main():
             logging.error("diff.xsd not provided and not found in the script's directory.")
             sys.exit(1)
 
-    # Determine if input paths are files or directories
-    original_is_dir = os.path.isdir(original_xml_path)
-    modified_is_dir = os.path.isdir(modified_xml_path)
-    diff_is_dir = os.path.isdir(diff_xml_path)
+    # Load the matching keys
+    try:
+        key_schema = load_key_schema(keys_json_path)
+        if keys_json_path:
+            logging.info(f"Using matching keys from: {keys_json_path}")
+    except (OSError, ValueError) as e:
+        logging.error(f"Error loading matching keys: {e}")
+        sys.exit(1)
 
-    if original_is_dir and modified_is_dir and diff_is_dir:
-        logging.info("Processing directories recursively.")
-        process_directories(original_xml_path, modified_xml_path, diff_xml_path, diff_xsd_path)
-    elif not original_is_dir and not modified_is_dir:
-        logging.info("Processing single trio of files.")
-        process_single_file(original_xml_path, modified_xml_path, diff_xml_path, diff_xsd_path)
-    else:
-        logging.error("Mismatch in input paths. Original and modified paths should be directories or both should be files.")
+    # Run all jobs of the manifest in this process
+    if batch_path:
+        try:
+            batch_jobs = read_manifest(batch_path, 'modified')
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading batch manifest: {e}")
+            sys.exit(1)
+        succeeded = run_batch(batch_jobs, lambda original, modified, diff: run_diff_job(
+            original, modified, diff, diff_xsd_path, key_schema, cache_dir, cache_size, verify, prefetch, jobs))
+        sys.exit(0 if succeeded else 1)
+
+    if not run_diff_job(original_xml_path, modified_xml_path, diff_xml_path, diff_xsd_path, key_schema,
+                        cache_dir, cache_size, verify, prefetch, jobs):
         sys.exit(1)
 
 if __name__ == "__main__":
+    # Only the frozen executable starts its worker processes through main, a plain script needs no multiprocessing here
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
     main()
\ No newline at end of file
@@ -1,35 +1,80 @@
 import argparse
-from lxml import etree
 import sys
 import os
 import re
 import logging
+import threading
+import queue
+import collections
+import xml_common
+from xml_common import (DEFAULT_KEY_SCHEMA, SELECTOR_ATTRIBUTES, resolve_selector, apply_operation, load_key_schema,
+                        select_key_rules, xpath_literal, index_children, get_subtree_hash, read_manifest, run_batch,
+                        load_xml_schema, run_writer)
+
+# Predicates selecting elements by their position among the siblings, e.g. [3] or [last()]
+POSITIONAL_PREDICATE_PATTERN = re.compile(r'\[\s*(\d+|last\(\)|position\(\))')
+
+# lxml takes a while to import, so it is loaded by load_lxml once there is XML to process
+etree = None
 
 def get_input(prompt):
     return input(prompt)
 
+def load_lxml():
+    """
+    Imports lxml on first use, so the help and the argument errors are shown without waiting for it.
+    Worker processes run it as their initializer.
+    """
+    global etree
+    if etree is None:
+        xml_common.load_lxml()
+        etree = xml_common.etree
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Apply XML diff to original XML or directory.')
-    parser.add_argument('original_xml', nargs='?', help='Path to the original XML file or directory')
-    parser.add_argument('diff_xml', nargs='?', help='Path to the diff XML file or directory')
-    parser.add_argument('output_xml', nargs='?', help='Path for the output XML file or directory')
+    parser.add_argument('original_xml', nargs='?',
+                        help='Path to the original XML file or directory, the old version of it for --rebase')
+    parser.add_argument('diff_xml', nargs='?', help='Path to the diff XML file or directory, not used with --conflicts')
+    parser.add_argument('output_xml', nargs='?',
+                        help='Path for the output XML file or directory, or for the rebased diff with --rebase, '
+                             'not used with --dry-run and --conflicts')
     parser.add_argument('--xsd', dest='diff_xsd', help='Path to the diff.xsd schema file.', default=None)
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help='Only apply the diffs in memory and report how their selectors match, without writing anything.')
+    parser.add_argument('--conflicts', nargs='+', metavar='MOD_DIFF',
+                        help='Report the conflicting edits of several mods, given by their diff files or directories.')
+    parser.add_argument('--rebase', metavar='NEW_ORIGINAL',
+                        help='Re-anchor the diff made for the original XML onto this new version of it.')
+    parser.add_argument('--keys', dest='keys_json', help='Path to a JSON file with matching keys per file type, for --rebase.',
+                        default=None)
+    parser.add_argument('--jobs', type=int,
+                        help='Number of parallel processes for --dry-run, --conflicts and --rebase (default: number of CPUs).',
+                        default=None)
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of file pairs to read ahead in parallel with processing directories (default: 0, disabled).')
+    parser.add_argument('--batch', dest='batch', metavar='MANIFEST',
+                        help='Run all jobs listed in a JSON or line-based manifest file, instead of the given paths.', default=None)
     args = parser.parse_args()
 
-    if not args.original_xml:
+    if not args.original_xml and not args.batch:
         args.original_xml = get_input('Enter path to original XML file  or directory: ').strip()
-    if not args.diff_xml:
+    if not args.diff_xml and not args.conflicts and not args.batch:
         args.diff_xml = get_input('Enter path to diff XML file or directory: ').strip()
-    if not args.output_xml:
+    if not args.output_xml and not args.dry_run and not args.conflicts and not args.batch:
         args.output_xml = get_input('Enter path for output XML file  or directory: ').strip()
 
     # Convert to absolute paths
-    args.original_xml = os.path.abspath(args.original_xml)
-    args.diff_xml = os.path.abspath(args.diff_xml)
-    args.output_xml = os.path.abspath(args.output_xml)
+    args.original_xml = os.path.abspath(args.original_xml) if args.original_xml else None
+    args.diff_xml = os.path.abspath(args.diff_xml) if args.diff_xml else None
+    args.conflicts = [os.path.abspath(path) for path in args.conflicts] if args.conflicts else None
+    args.output_xml = os.path.abspath(args.output_xml) if args.output_xml else None
     args.diff_xsd = os.path.abspath(args.diff_xsd) if args.diff_xsd else None
+    args.rebase = os.path.abspath(args.rebase) if args.rebase else None
+    args.keys_json = os.path.abspath(args.keys_json) if args.keys_json else None
+    args.batch = os.path.abspath(args.batch) if args.batch else None
 
-    return args.original_xml, args.diff_xml, args.output_xml, args.diff_xsd
+    return (args.original_xml, args.diff_xml, args.output_xml, args.diff_xsd, args.prefetch, args.dry_run, args.conflicts,
+            args.jobs, args.batch, args.rebase, args.keys_json)
 
 def validate_diff_xml(diff_xml_path, xsd_path):
     """
@@ -43,9 +88,7 @@ def validate_diff_xml(diff_xml_path, xsd_path):
         bool: True if validation is successful, False otherwise.
     """
     try:
-        with open(xsd_path, 'rb') as f:
-            xmlschema_doc = etree.parse(f)
-            xmlschema = etree.XMLSchema(xmlschema_doc)
+        xmlschema = load_xml_schema(xsd_path)
     except Exception as e:
         logging.error(f"Error parsing diff.xsd: {e}")
         return False
@@ -119,259 +162,996 @@ def detect_indentation(xml_path):
 
     return per_level_indent
 
-def apply_add(diff_element, original_root):
-    sel = diff_element.get('sel')
-    pos = diff_element.get('pos', 'after')
-    new_elements = list(diff_element)
+def read_file_pair(original_file, diff_file, diff_xsd_path):
+    """
+    Validates the diff file, then reads and parses it together with the original XML file.
+    There is nothing but I/O and parsing, so it can run in a reader thread.
+
+    Args:
+        original_file (str): Path to the original XML file.
+        diff_file (str): Path to the diff XML file.
+        diff_xsd_path (str): Path to the diff.xsd schema file.
+
+    Returns:
+        tuple: The original tree, its indentation and the diff tree; or None on error.
+    """
+    # Validate the diff file
+    if not validate_diff_xml(diff_file, diff_xsd_path):
+        logging.error(f"Validation failed for diff file '{diff_file}'. Skipping.")
+        return None
 
-    target_nodes = original_root.xpath(sel)
-    if not target_nodes:
-        logging.warning(f"No nodes found for add selector: {sel}")
+    # Parse the original XML file
+    try:
+        original_tree = etree.parse(original_file)
+        logging.info(f"Parsed original XML: {original_file}")
+    except Exception as e:
+        logging.error(f"Error parsing original XML '{original_file}': {e}")
+        return None
+
+    # Parse the diff XML file
+    try:
+        parser = etree.XMLParser(remove_blank_text=False)
+        diff_tree = etree.parse(diff_file, parser)
+        logging.info(f"Parsed diff XML: {diff_file}")
+    except Exception as e:
+        logging.error(f"Error parsing diff XML '{diff_file}': {e}")
+        return None
+
+    # Detect indentation
+    indent_str = detect_indentation(original_file)
+    logging.info(f"Detected indentation for '{original_file}': '{repr(indent_str)}'")
+    return original_tree, indent_str, diff_tree
+
+def write_patched_xml(original_tree, output_file, indent_str):
+    """
+    Indents and writes the patched XML tree.
+
+    Args:
+        original_tree (etree.ElementTree): The patched XML tree.
+        output_file (str): Path where the patched XML will be saved.
+        indent_str (str): The detected per-level indentation string.
+    """
+    # Re-indent the entire XML tree for consistent formatting
+    if hasattr(etree, 'indent'):
+        etree.indent(original_tree, space=indent_str)
+        logging.info(f"Applied indentation to the output XML tree for '{output_file}'.")
+
+    # Write the patched XML to the output file
+    try:
+        original_tree.write(output_file, pretty_print=True, xml_declaration=True, encoding='utf-8')
+        logging.info(f"Patched XML successfully written to '{output_file}'.")
+    except Exception as e:
+        logging.error(f"Error writing patched XML to '{output_file}': {e}")
+
+def process_single_file(original_file, diff_file, output_file, diff_xsd_path, loaded=None, write_queue=None):
+    """
+    Processes a single trio of original, diff, and output files.
+
+    Args:
+        original_file (str): Path to the original XML file.
+        diff_file (str): Path to the diff XML file.
+        output_file (str): Path where the patched XML will be saved.
+        diff_xsd_path (str): Path to the diff.xsd schema file.
+        loaded (concurrent.futures.Future): Prefetched result of read_file_pair, the files are read here if not provided.
+        write_queue (queue.Queue): Queue of the writer thread, the patched XML is written here if not provided.
+
+    Returns:
+        None
+    """
+    # Validate the diff file and parse both files
+    if loaded is not None:
+        loaded = loaded.result()
+    else:
+        loaded = read_file_pair(original_file, diff_file, diff_xsd_path)
+    if loaded is None:
         return
+    original_tree, indent_str, diff_tree = loaded
+
+    # Get the root element of the diff XML
+    diff_root = diff_tree.getroot()
+
+    # Apply each operation in the diff XML
+    for operation in diff_root:
+        if not isinstance(operation.tag, str):
+            continue
+        try:
+            matched = apply_operation(operation, original_tree.getroot())
+        except etree.XPathError as e:
+            logging.error(f"Invalid selector '{operation.get('sel')}' in diff file '{diff_file}': {e}. Skipping.")
+            continue
+        if matched is None:
+            logging.warning(f"Unknown operation: {operation.tag} in diff file '{diff_file}'. Skipping.")
+
+    # Determine the output directory
+    output_dir = os.path.dirname(output_file)
+
+    # If the output path is a directory, append the original file name
+    if os.path.isdir(output_file):
+        output_dir = output_file
+        output_file = os.path.join(output_dir, os.path.basename(original_file))
+
+    # Ensure the output directory exists
+    if output_dir and not os.path.exists(output_dir):
+        try:
+            os.makedirs(output_dir)
+            logging.info(f"Created output directory: {output_dir}")
+        except Exception as e:
+            logging.error(f"Failed to create output directory '{output_dir}': {e}")
+            return
+
+    # Indent and write the patched XML
+    if write_queue is not None:
+        write_queue.put((write_patched_xml, (original_tree, output_file, indent_str)))
+    else:
+        write_patched_xml(original_tree, output_file, indent_str)
+
+def process_directories(original_path, diff_path, output_path, diff_xsd_path, prefetch=0):
+    """
+    Processes directories by recursively applying each diff file to the corresponding original XML file.
+
+    With prefetch, reader threads parse the next file pairs and a writer thread writes the patched
+    files while the current one is patched, with bounded queues keeping the memory use in check.
 
-    for target in target_nodes:
-        for new_element in new_elements:
-            # Copy the new element to avoid modifying the original
-            new_elem_str = etree.tostring(new_element, encoding='utf-8').decode('utf-8')
-            # Remove the namespace declaration from the new element
-            clean_new_elem_str = re.sub(r'\sxmlns:xsi=".*?"', '', new_elem_str)
-            # Parse the cleaned new element
+    Args:
+        original_path (str): Path to the original XML directory.
+        diff_path (str): Path to the diff XML directory.
+        output_path (str): Path for the output XML directory.
+        diff_xsd_path (str): Path to the diff.xsd schema file.
+        prefetch (int): Number of file pairs to read ahead, 0 to process the files one by one.
+    """
+    import concurrent.futures
+
+    trios = []
+    # Traverse the diff directory
+    for root, dirs, files in os.walk(diff_path):
+        for file in files:
+            if file.lower().endswith('.xml'):
+                diff_file_path = os.path.join(root, file)
+                # Determine the relative path
+                rel_path = os.path.relpath(diff_file_path, diff_path)
+                original_file_path = os.path.join(original_path, rel_path)
+                output_file_path = os.path.join(output_path, rel_path)
+
+                if not os.path.isfile(original_file_path):
+                    logging.warning(f"original file does not exist for diff file '{diff_file_path}'. Skipping.")
+                    continue
+
+                trios.append((original_file_path, diff_file_path, output_file_path))
+
+    if prefetch > 0:
+        write_queue = queue.Queue(maxsize=prefetch)
+        writer = threading.Thread(target=run_writer, args=(write_queue,), name='writer')
+        writer.start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix='reader') as readers:
+                loads = collections.deque()
+                for index, (original_file_path, diff_file_path, output_file_path) in enumerate(trios):
+                    # Keep the next file pairs loading while the current one is processed
+                    for next_original, next_diff, _ in trios[index + len(loads):index + prefetch + 1]:
+                        loads.append(readers.submit(read_file_pair, next_original, next_diff, diff_xsd_path))
+                    process_single_file(original_file_path, diff_file_path, output_file_path, diff_xsd_path,
+                                        loaded=loads.popleft(), write_queue=write_queue)
+        finally:
+            write_queue.put(None)
+            writer.join()
+    else:
+        for original_file_path, diff_file_path, output_file_path in trios:
+            # Process the single trio of diff, original, and output
+            process_single_file(original_file_path, diff_file_path, output_file_path, diff_xsd_path)
+
+def describe_node(node):
+    """
+    Describes a node selected by a diff operation for the dry-run report.
+
+    Args:
+        node: An element, attribute or text selected by an XPath expression.
+
+    Returns:
+        str: The absolute path of the node, with the identity attribute of the element if it has one.
+    """
+    suffix = ''
+    if isinstance(node, etree._ElementUnicodeResult):
+        suffix = f"/@{node.attrname}" if node.is_attribute else '/text()'
+        node = node.getparent()
+    if not isinstance(node, etree._Element):
+        return repr(node)
+    path = node.getroottree().getpath(node) + suffix
+    for attr in ('id', 'name', 'macro', 'ref'):
+        if node.get(attr) is not None:
+            return f"{path} ({attr}=\"{node.get(attr)}\")"
+    return path
+
+def dry_run_file(original_file, diff_file, diff_xsd_path):
+    """
+    Applies the diff to the original XML in memory only, recording how each operation's selector matched.
+    Later selectors see the effects of the earlier operations, as in a real patch run.
+    It catches the errors and does not log the single steps, so it can run in a worker process.
+
+    Args:
+        original_file (str): Path to the original XML file.
+        diff_file (str): Path to the diff XML file.
+        diff_xsd_path (str): Path to the diff.xsd schema file.
+
+    Returns:
+        tuple: A list of (number, operation, selector, match count, note) tuples and an error message;
+               the list is None if the diff could not be applied at all.
+               The match count is None for invalid selectors and unknown operations.
+    """
+    if not os.path.isfile(original_file):
+        return None, f"Original XML file does not exist for diff file '{diff_file}'."
+    if not validate_diff_xml(diff_file, diff_xsd_path):
+        return None, f"Diff file '{diff_file}' is not valid against diff.xsd."
+    try:
+        original_root = etree.parse(original_file).getroot()
+        diff_root = etree.parse(diff_file).getroot()
+    except Exception as e:
+        return None, f"Error parsing '{diff_file}' or its original XML: {e}"
+
+    results = []
+    operations = [operation for operation in diff_root if isinstance(operation.tag, str)]
+    # Only the report is of interest, not the single steps of applying the operations
+    logging.disable(logging.WARNING)
+    try:
+        for number, operation in enumerate(operations, 1):
+            sel = operation.get('sel')
+            note = None
             try:
-                new_elem = etree.fromstring(clean_new_elem_str)
-            except etree.XMLSyntaxError as e:
-                logging.error(f"Failed to parse cleaned new element: {e}")
-                continue
+                # Without the old original a move cannot be detected, so only the current target is shown
+                if sel and POSITIONAL_PREDICATE_PATTERN.search(sel):
+                    target_nodes = resolve_selector(sel, original_root)
+                    if target_nodes:
+                        note = f"positional selector, at {describe_node(target_nodes[0])}"
+                matched = apply_operation(operation, original_root)
+                if matched is None:
+                    note = 'unknown operation'
+            except etree.XPathError as e:
+                matched, note = None, f"invalid selector: {e}"
+            results.append((number, operation.tag, sel, matched, note))
+    except Exception as e:
+        return None, f"Error applying '{diff_file}': {e}"
+    finally:
+        logging.disable(logging.NOTSET)
+    return results, None
 
-            # Insert based on position
-            parent = target.getparent()
-            if parent is not None:
-                if pos == 'before':
-                    parent.insert(parent.index(target), new_elem)
-                    logging.info(f"Added new element '{new_elem.tag}' before '{target.tag}' in '{parent.tag}'.")
-                elif pos == 'after':
-                    parent.insert(parent.index(target) + 1, new_elem)
-                    logging.info(f"Added new element '{new_elem.tag}' after '{target.tag}' in '{parent.tag}'.")
-                elif pos == 'prepend':
-                    parent.insert(0, new_elem)
-                    logging.info(f"Prepended new element '{new_elem.tag}' to '{parent.tag}'.")
-                else:
-                    logging.warning(f"Unknown position: {pos}. Skipping insertion.")
-
-def apply_replace(diff_element, original_root):
-    """
-    Applies the 'replace' operation defined in the diff XML to the original XML.
+def report_dry_run(diff_file, results):
+    """
+    Logs the dry-run results of a diff file.
 
     Args:
-        diff_element (etree.Element): The <replace> element containing replace operations.
-        original_root (etree.Element): The root of the original XML tree.
+        diff_file (str): Path or relative path of the diff XML file.
+        results (list): The results returned by dry_run_file.
+
+    Returns:
+        int: Number of operations which did not match anything or could not be applied.
     """
-    sel = diff_element.get('sel')
-    if sel is None:
-        logging.warning("Replace operation missing 'sel' attribute.")
-        return
+    unmatched = sum(1 for _, _, _, matched, _ in results if not matched)
+    multiple = sum(1 for _, _, _, matched, _ in results if matched and matched > 1)
+    positional = sum(1 for _, _, _, matched, note in results if matched and note)
+    logging.info(f"Dry run of '{diff_file}': {len(results)} operation(s), {unmatched} without match, "
+                 f"{multiple} with multiple matches, {positional} positional selector(s).")
+    for number, tag, sel, matched, note in results:
+        if matched is None:
+            logging.error(f"  #{number} {tag} {sel}: {note}")
+        elif matched == 0:
+            logging.warning(f"  #{number} {tag} {sel}: no match")
+        elif matched > 1:
+            logging.warning(f"  #{number} {tag} {sel}: {matched} matches")
+        elif note:
+            logging.info(f"  #{number} {tag} {sel}: 1 match, {note}")
+        else:
+            logging.info(f"  #{number} {tag} {sel}: 1 match")
+    return unmatched
 
-    new_content = diff_element.text  # For text replacement
-    new_element = diff_element.find('new')  # For element replacement
+def dry_run_directories(original_path, diff_path, diff_xsd_path, jobs=None):
+    """
+    Runs the dry run for every diff file of a directory against the corresponding original XML file,
+    in parallel processes. The results are reported in the order of the file paths.
 
-    target_nodes = original_root.xpath(sel)
-    if not target_nodes:
-        logging.warning(f"No nodes found for replace selector: {sel}")
-        return
+    Args:
+        original_path (str): Path to the original XML directory.
+        diff_path (str): Path to the diff XML directory.
+        diff_xsd_path (str): Path to the diff.xsd schema file.
+        jobs (int): Number of worker processes, defaults to the number of CPUs.
 
-    for node in target_nodes:
-        if isinstance(node, etree._Element):
-            if new_content is not None:
-                # Replace element text
-                original_text = node.text
-                node.text = new_content
-                logging.debug(f"Replaced text of element '{node.tag}' from '{original_text}' to '{new_content}'.")
-            elif new_element is not None:
-                # Replace entire element with new_element subtree
-                try:
-                    replacement = etree.fromstring(etree.tostring(new_element, encoding='utf-8'))
-                    parent = node.getparent()
-                    if parent is not None:
-                        parent.replace(node, replacement)
-                        logging.info(f"Replaced element '{node.tag}' with '{replacement.tag}'.")
-                except etree.XMLSyntaxError as e:
-                    logging.error(f"Invalid XML in <new> element: {e}")
+    Returns:
+        tuple: Numbers of operations without match and of diff files that could not be applied.
+    """
+    import concurrent.futures
+
+    relative_paths = []
+    for root, dirs, files in os.walk(diff_path):
+        for file in files:
+            if file.lower().endswith('.xml'):
+                relative_paths.append(os.path.relpath(os.path.join(root, file), diff_path))
+
+    unmatched = 0
+    errors = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=load_lxml) as executor:
+        futures = [
+            (relative_path, executor.submit(dry_run_file, os.path.join(original_path, relative_path),
+                                            os.path.join(diff_path, relative_path), diff_xsd_path))
+            for relative_path in sorted(relative_paths)
+        ]
+        for relative_path, future in futures:
+            results, message = future.result()
+            if results is None:
+                errors += 1
+                logging.error(message)
             else:
-                logging.warning(f"No replacement content provided for selector: {sel}")
-        elif isinstance(node, etree._ElementUnicodeResult):
-            # Replacing an attribute value
-            parent = node.getparent()
-            attr = node.attrname
-            original_value = parent.get(attr)
-            parent.set(attr, new_content)
-            logging.debug(f"Replaced attribute '{attr}' of element '{parent.tag}' from '{original_value}' to '{new_content}'.")
-        else:
-            logging.warning(f"Unsupported node type for replacement: {type(node)}")
+                unmatched += report_dry_run(relative_path, results)
+    logging.info(f"Dry run of {len(relative_paths)} diff file(s): {unmatched} operation(s) without match, "
+                 f"{errors} file(s) failed.")
+    return unmatched, errors
 
-def apply_remove(diff_element, original_root):
+def index_diff_operations(original_root, mod_name, diff_root, edits, anchors):
     """
-    Applies the 'remove' operation defined in the diff XML to the original XML.
+    Resolves the selectors of a mod's diff against the original XML and records the touched nodes.
+    The original XML is not changed.
 
     Args:
-        diff_element (etree.Element): The <remove> element containing remove operations.
         original_root (etree.Element): The root of the original XML tree.
+        mod_name (str): Name of the mod the diff belongs to, for the report.
+        diff_root (etree.Element): The root of the diff XML tree.
+        edits (dict): (element, attribute) to list of (mod name, operation) changing it, filled in here.
+                      The attribute is '@name' for attributes, 'text()' for texts and None for the whole element.
+        anchors (dict): Element to list of (mod name, operation) adding elements into or next to it, filled in here.
+
+    Returns:
+        list: Descriptions of the operations whose selectors do not match anything in the original XML.
     """
-    sel = diff_element.get('sel')
-    if sel is None:
-        logging.warning("Remove operation missing 'sel' attribute.")
-        return
+    unresolved = []
+    operations = [operation for operation in diff_root if isinstance(operation.tag, str)]
+    for number, operation in enumerate(operations, 1):
+        sel = operation.get('sel')
+        label = (mod_name, f"#{number} {operation.tag} {sel}")
+        try:
+            target_nodes = resolve_selector(sel, original_root) if sel else []
+        except etree.XPathError as e:
+            unresolved.append(f"{label[0]} {label[1]}: invalid selector: {e}")
+            continue
+        if not target_nodes:
+            # Also the selectors relying on the mod's own earlier operations
+            unresolved.append(f"{label[0]} {label[1]}: no match in the original XML")
+            continue
+        has_new_element = any(isinstance(child.tag, str) for child in operation)
+        for node in target_nodes:
+            if isinstance(node, etree._ElementUnicodeResult):
+                attribute = f"@{node.attrname}" if node.is_attribute else 'text()'
+                edits.setdefault((node.getparent(), attribute), []).append(label)
+            elif not isinstance(node, etree._Element):
+                continue
+            elif operation.tag == 'add' and (operation.get('type') or '').startswith('@'):
+                edits.setdefault((node, operation.get('type')), []).append(label)
+            elif operation.tag == 'add':
+                anchors.setdefault(node, []).append(label)
+            elif operation.tag == 'replace' and not has_new_element:
+                edits.setdefault((node, 'text()'), []).append(label)
+            else:
+                edits.setdefault((node, None), []).append(label)
+    return unresolved
 
-    target_nodes = original_root.xpath(sel)
-    if not target_nodes:
-        logging.warning(f"No nodes found for remove selector: {sel}")
-        return
+def find_conflicts(edits, anchors):
+    """
+    Finds the overlapping edits of different mods in the index built by index_diff_operations.
+
+    Args:
+        edits (dict): (element, attribute) to list of (mod name, operation) changing it.
+        anchors (dict): Element to list of (mod name, operation) adding elements into or next to it.
+
+    Returns:
+        list: Descriptions of the conflicts.
+    """
+    conflicts = []
+
+    # The same node or attribute changed by several mods
+    for (element, attribute), labels in edits.items():
+        if len({mod_name for mod_name, _ in labels}) > 1:
+            target = describe_node(element) + (f" {attribute}" if attribute else '')
+            conflicts.append(f"{target} is changed by several mods: " +
+                             '; '.join(f"{mod_name} {operation}" for mod_name, operation in labels))
+
+    # Changes inside of, or anchored on, an element another mod replaces or removes
+    def report_under_replaced(element, labels, include_self, what):
+        ancestors = element.iterancestors() if not include_self else [element, *element.iterancestors()]
+        for ancestor in ancestors:
+            replaced = edits.get((ancestor, None))
+            if not replaced:
+                continue
+            for mod_name, operation in labels:
+                others = [f"{other_mod} {other_operation}" for other_mod, other_operation in replaced
+                          if other_mod != mod_name]
+                if others:
+                    conflicts.append(f"{mod_name} {operation} {what} {describe_node(ancestor)}, "
+                                     f"which is replaced or removed by: " + '; '.join(others))
+
+    for element, labels in anchors.items():
+        report_under_replaced(element, labels, True, 'adds at or under')
+    for (element, attribute), labels in edits.items():
+        report_under_replaced(element, labels, attribute is not None, 'changes a node under')
+    return conflicts
+
+def check_conflicts_file(original_file, diff_files):
+    """
+    Builds the conflict index of one original XML file, resolving the diffs of all mods against it.
+    It catches the errors, so it can run in a worker process.
+
+    Args:
+        original_file (str): Path to the original XML file.
+        diff_files (list): (mod name, path to the diff XML file) pairs.
 
-    for node in target_nodes:
-        parent = node.getparent()
-        if parent is None:
-            logging.warning(f"Cannot remove root element '{node.tag}'. Skipping.")
+    Returns:
+        tuple: Lists of conflict descriptions, of unresolved operations and of error messages.
+    """
+    try:
+        original_root = etree.parse(original_file).getroot()
+    except Exception as e:
+        return [], [], [f"Error parsing original XML '{original_file}': {e}"]
+
+    edits = {}
+    anchors = {}
+    unresolved = []
+    errors = []
+    for mod_name, diff_file in diff_files:
+        try:
+            diff_root = etree.parse(diff_file).getroot()
+        except Exception as e:
+            errors.append(f"Error parsing diff XML '{diff_file}': {e}")
             continue
+        unresolved.extend(index_diff_operations(original_root, mod_name, diff_root, edits, anchors))
+    return find_conflicts(edits, anchors), unresolved, errors
 
-        # Remove the node
-        parent.remove(node)
-        logging.debug(f"Removed element '{node.tag}' from '{parent.tag}'.")
-
-        # Adjust indentation
-        # If the removed node had a tail with indentation, propagate it to the previous sibling or parent
-        if node.tail and node.tail.strip() == '':
-            index = parent.index(node) if node in parent else -1
-            if index > 0:
-                # Get the previous sibling
-                prev_sibling = parent[index - 1]
-                if prev_sibling.tail is not None:
-                    # Append the removed node's tail to the previous sibling's tail
-                    prev_sibling.tail += node.tail
-                else:
-                    prev_sibling.tail = node.tail
+def check_conflicts(original_path, diff_paths, jobs=None):
+    """
+    Reports the overlapping edits of several mods, each given by its diff file or directory.
+    Directories are indexed per file, in parallel processes.
+
+    Args:
+        original_path (str): Path to the original XML file or directory.
+        diff_paths (list): Paths to the diff XML files or directories of the mods.
+        jobs (int): Number of worker processes, defaults to the number of CPUs.
+
+    Returns:
+        tuple: Numbers of conflicts and of errors.
+    """
+    import concurrent.futures
+
+    # Group the diff files of all mods by the original file they apply to
+    grouped = collections.defaultdict(list)
+    if os.path.isdir(original_path):
+        for diff_path in diff_paths:
+            mod_name = os.path.basename(diff_path)
+            for root, dirs, files in os.walk(diff_path):
+                for file in files:
+                    if file.lower().endswith('.xml'):
+                        diff_file = os.path.join(root, file)
+                        grouped[os.path.relpath(diff_file, diff_path)].append((mod_name, diff_file))
+    else:
+        grouped[os.path.basename(original_path)] = [(diff_path, diff_path) for diff_path in diff_paths]
+
+    conflicts_count = 0
+    errors_count = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=load_lxml) as executor:
+        futures = []
+        for relative_path in sorted(grouped):
+            original_file = (os.path.join(original_path, relative_path) if os.path.isdir(original_path)
+                             else original_path)
+            if not os.path.isfile(original_file):
+                logging.warning(f"Original file does not exist for '{relative_path}'. Skipping.")
+                continue
+            futures.append((relative_path, executor.submit(check_conflicts_file, original_file, grouped[relative_path])))
+        for relative_path, future in futures:
+            conflicts, unresolved, errors = future.result()
+            for message in errors:
+                logging.error(message)
+            for message in unresolved:
+                logging.warning(f"{relative_path}: {message}")
+            for message in conflicts:
+                logging.error(f"Conflict in '{relative_path}': {message}")
+            conflicts_count += len(conflicts)
+            errors_count += len(errors)
+    logging.info(f"Checked {len(grouped)} file(s) of {len(diff_paths)} mod(s): {conflicts_count} conflict(s), "
+                 f"{errors_count} error(s).")
+    return conflicts_count, errors_count
+
+def match_original_trees(old_root, new_root, key_rules):
+    """
+    Matches the elements of the old and new versions of an original XML file.
+
+    Children of matched elements are matched by their matching keys. A child matched by its position
+    only must also have the same subtree, otherwise its sibling with the same subtree is taken.
+    The elements left over, e.g. moved to another parent, are matched by their subtree hash,
+    then by an identity attribute unique in the whole new tree. Both are looked up in indexes
+    of the new tree, built once when the first elements are left over.
+
+    Args:
+        old_root (etree.Element): The root of the old original XML tree.
+        new_root (etree.Element): The root of the new original XML tree.
+        key_rules (dict): Element pattern to list of identity attributes, as returned by select_key_rules.
+
+    Returns:
+        dict: Each matched element of the old tree to the corresponding element of the new tree.
+    """
+    counterparts = {}
+    if old_root.tag != new_root.tag:
+        return counterparts
+
+    rules_cache = {}
+    old_hashes = {}
+    new_hashes = {}
+    by_hash = by_value = None
+    matched = {new_root}
+    pairs = [(old_root, new_root)]
+    unmatched = []
+    while pairs or unmatched:
+        if not pairs:
+            # Look for the same subtree, or the same identity, anywhere in the new tree
+            if by_hash is None:
+                by_hash = {}
+                by_value = {}
+                key_attr_names = set().union(*key_rules.values())
+                for element in new_root.iter(etree.Element):
+                    if element not in matched:
+                        by_hash.setdefault(get_subtree_hash(element, new_hashes), []).append(element)
+                        for attr in key_attr_names:
+                            value = element.get(attr)
+                            if value is not None:
+                                by_value.setdefault((element.tag, attr, value), []).append(element)
+            for old_element in unmatched:
+                candidates = [element for element in by_hash.get(get_subtree_hash(old_element, old_hashes), [])
+                              if element not in matched]
+                if len(candidates) != 1:
+                    key_attrs = rules_cache[(old_element.getparent().tag, old_element.tag)][0]
+                    for attr in key_attrs:
+                        value = old_element.get(attr)
+                        if value is None:
+                            continue
+                        candidates = [element for element in by_value.get((old_element.tag, attr, value), [])
+                                      if element not in matched]
+                        if len(candidates) == 1:
+                            break
+                if len(candidates) == 1:
+                    matched.add(candidates[0])
+                    pairs.append((old_element, candidates[0]))
+            unmatched = []
+            continue
+
+        old_parent, new_parent = pairs.pop()
+        counterparts[old_parent] = new_parent
+        old_keys = index_children(old_parent, key_rules, rules_cache, {})
+        if not old_keys:
+            continue
+        new_keys = {info[0]: child for child, info in index_children(new_parent, key_rules, rules_cache, {}).items()}
+        old_key_set = {info[0] for info in old_keys.values()}
+        new_by_hash = None
+        for old_child, (match_key, _, _) in old_keys.items():
+            new_child = new_keys.get(match_key)
+            tag = old_child.tag
+            if not match_key.startswith(f'{tag}[@') and (f'{tag}[2]' in old_key_set or f'{tag}[2]' in new_keys):
+                # A position among several siblings is only trusted as long as the subtree is the same
+                old_hash = get_subtree_hash(old_child, old_hashes)
+                if new_child is None or get_subtree_hash(new_child, new_hashes) != old_hash:
+                    if new_by_hash is None:
+                        new_by_hash = {}
+                        for child in new_parent.iterchildren(etree.Element):
+                            new_by_hash.setdefault((child.tag, get_subtree_hash(child, new_hashes)), []).append(child)
+                    same = new_by_hash.get((tag, old_hash), [])
+                    if len(same) == 1:
+                        new_child = same[0]
+            if new_child is None or new_child in matched:
+                unmatched.append(old_child)
             else:
-                # If there is no previous sibling, adjust the parent's text or tail
-                if parent.text is not None:
-                    parent.text += node.tail
-                else:
-                    parent.text = node.tail
+                matched.add(new_child)
+                pairs.append((old_child, new_child))
+    return counterparts
 
-        # Optional: Clean stray whitespace
-        clean_whitespace(parent)
+def split_selected_node(node):
+    """
+    Splits a node selected by a diff operation into its element and the selector suffix.
 
-def clean_whitespace(parent):
+    Args:
+        node: An element, attribute or text selected by an XPath expression.
+
+    Returns:
+        tuple: The element and '' for elements, '@name' for attributes or 'text()' for texts;
+            (None, None) for other nodes.
+    """
+    if isinstance(node, etree._ElementUnicodeResult):
+        if node.is_attribute:
+            return node.getparent(), f'@{node.attrname}'
+        if node.is_text:
+            return node.getparent(), 'text()'
+        return None, None
+    if isinstance(node, etree._Element) and isinstance(node.tag, str):
+        return node, ''
+    return None, None
+
+def is_in_tree(element, root):
     """
-    Cleans up stray whitespace in the XML tree after removal operations.
+    Checks whether an element is still a part of the tree, and was not removed or replaced.
 
     Args:
-        parent (etree.Element): The parent element whose children may have stray whitespace.
+        element (etree.Element): The element to check.
+        root (etree.Element): The root of the XML tree.
+
+    Returns:
+        bool: True if the element is the root or one of its descendants.
     """
-    if len(parent) > 0:
-        # Ensure the last child has a tail with proper indentation
-        last_child = parent[-1]
-        if not last_child.tail or last_child.tail.strip() != '':
-            last_child.tail = '\n' + '    ' * (get_element_level(last_child) - 1)
-    else:
-        # If the parent has no children, adjust its text
-        if not parent.text or parent.text.strip() != '':
-            parent.text = '\n' + '    ' * (get_element_level(parent) - 1)
+    for ancestor in element.iterancestors():
+        element = ancestor
+    return element is root
 
-def get_element_level(element):
+def generate_rebased_xpath(element, root, key_rules):
     """
-    Determines the depth level of an element in the XML tree.
+    Generates the selector of an element of the new tree, the same way as xml-diff.py:
+    an absolute path built from the identity steps, or '//' with an attribute unique
+    in the whole tree for elements more than two levels below the root.
+    The tree changes with every applied operation, so the steps are counted by XPath on the current tree.
 
     Args:
-        element (etree.Element): The element whose level is to be determined.
+        element (etree.Element): The element for which to generate the XPath.
+        root (etree.Element): The root element of the XML tree.
+        key_rules (dict): Element pattern to list of identity attributes, as returned by select_key_rules.
 
     Returns:
-        int: The depth level of the element (root is 0).
+        str: The XPath expression pointing to the element.
+    """
+    path = []
+    selector_attrs = []
+    current = element
+    while current.getparent() is not None:
+        parent = current.getparent()
+        tag = current.tag
+        if f'{parent.tag}/{tag}' in key_rules:
+            key_attrs = key_rules[f'{parent.tag}/{tag}']
+        elif tag in key_rules:
+            key_attrs = key_rules[tag]
+        else:
+            key_attrs = key_rules.get('*', [])
+        attrs = [attr for attr in key_attrs + [attr for attr in SELECTOR_ATTRIBUTES if attr not in key_attrs]
+                 if current.get(attr) is not None]
+        if current is element:
+            selector_attrs = attrs
+
+        step = None
+        if parent.xpath(f'count({tag})') == 1:
+            step = tag
+        for attr in attrs if step is None else []:
+            literal = xpath_literal(current.get(attr))
+            if parent.xpath(f'count({tag}[@{attr}={literal}])') == 1:
+                step = f'{tag}[@{attr}={literal}]'
+                break
+        if step is None:
+            step = f"{tag}[{int(current.xpath(f'count(preceding-sibling::{tag})')) + 1}]"
+        path.insert(0, f'/{step}')
+        current = parent
+    path.insert(0, f'/{current.tag}')
+
+    if len(path) > 3:
+        for attr in selector_attrs:
+            sel = f'//{element.tag}[@{attr}={xpath_literal(element.get(attr))}]'
+            if root.xpath(f'count({sel})') == 1:
+                return sel
+    return ''.join(path)
+
+def find_added_elements(operation, target, replaced_at):
     """
-    level = 0
-    parent = element.getparent()
-    while parent is not None:
-        level += 1
-        parent = parent.getparent()
-    return level
+    Returns the elements an applied operation inserted for one of its targets.
 
-def process_single_file(original_file, diff_file, output_file, diff_xsd_path):
+    Args:
+        operation (etree.Element): The applied <add> or <replace> element.
+        target (etree.Element): The target element of the operation.
+        replaced_at (tuple): Parent and index of the target before it was replaced as a whole, None for additions.
+
+    Returns:
+        list: The inserted elements, in document order.
     """
-    Processes a single trio of original, diff, and output files.
+    if replaced_at is not None:
+        parent, index = replaced_at
+        return [parent[index]]
+    count = sum(1 for child in operation if isinstance(child.tag, str))
+    pos = operation.get('pos')
+    if pos is None:
+        return target[len(target) - count:]
+    if pos == 'prepend':
+        return target[:count]
+    parent = target.getparent()
+    index = parent.index(target)
+    if pos == 'before':
+        return parent[index - count:index]
+    return parent[index + 1:index + 1 + count]
+
+def rebase_operation(operation, old_root, new_root, counterparts, key_rules):
+    """
+    Finds where the targets of an operation are in the new tree and re-anchors its selector on them.
+    The operation is then applied to the old tree, and if it was placed, to the new one too,
+    so the following operations see its effects in both versions. The elements it inserts
+    are added to the counterparts.
+
+    The selector is kept as it is if it still selects the same nodes in the new tree.
 
     Args:
-        original_file (str): Path to the original XML file.
+        operation (etree.Element): The <add>, <replace> or <remove> element, its 'sel' is updated in place.
+        old_root (etree.Element): The root of the old original XML tree.
+        new_root (etree.Element): The root of the new original XML tree.
+        counterparts (dict): Old elements to the corresponding new ones, as returned by match_original_trees.
+        key_rules (dict): Element pattern to list of identity attributes, as returned by select_key_rules.
+
+    Returns:
+        tuple: The new selector, the reason why the operation could not be placed, and a note about
+            a target changed in the new version; the reason and the note are None if there is none.
+    """
+    sel = operation.get('sel')
+    try:
+        old_nodes = resolve_selector(sel, old_root) if sel else []
+    except etree.XPathError as e:
+        return None, f"invalid selector: {e}", None
+    if not old_nodes:
+        return None, 'no match in the old original XML', None
+
+    # The counterparts of the targets in the new tree
+    problem = None
+    targets = []
+    for node in old_nodes:
+        element, suffix = split_selected_node(node)
+        if element is None:
+            problem = f"selects {describe_node(node)}, which is not an element, attribute or text"
+            break
+        counterpart = counterparts.get(element)
+        if counterpart is None or not is_in_tree(counterpart, new_root):
+            problem = f"{describe_node(element)} not found in the new original XML"
+            break
+        targets.append((counterpart, suffix))
+
+    new_sel = None
+    new_nodes = []
+    if problem is None:
+        new_nodes = resolve_selector(sel, new_root)
+        if [split_selected_node(node) for node in new_nodes] == targets:
+            new_sel = sel
+        elif len(targets) > 1:
+            problem = f"selects {len(targets)} nodes, which are not the same ones in the new original XML"
+        else:
+            counterpart, suffix = targets[0]
+            new_sel = generate_rebased_xpath(counterpart, new_root, key_rules) + (f'/{suffix}' if suffix else '')
+            new_nodes = resolve_selector(new_sel, new_root)
+            if [split_selected_node(node) for node in new_nodes] != targets:
+                problem = f"{describe_node(counterpart)} has no {suffix} in the new original XML"
+                new_sel = None
+
+    # A changed vanilla element removed or replaced as a whole is worth a look after the update
+    whole = operation.tag == 'remove' or (operation.tag == 'replace' and
+                                          any(isinstance(child.tag, str) for child in operation))
+    note = None
+    if problem is None:
+        for node, (counterpart, suffix) in zip(old_nodes, targets):
+            element, _ = split_selected_node(node)
+            if suffix.startswith('@') and element.get(suffix[1:]) != counterpart.get(suffix[1:]):
+                note = (f"{suffix} changed in the new original XML from '{element.get(suffix[1:])}' "
+                        f"to '{counterpart.get(suffix[1:])}'")
+            elif suffix == 'text()' and (element.text or '').strip() != (counterpart.text or '').strip():
+                note = 'text changed in the new original XML'
+            elif not suffix and whole and get_subtree_hash(element, {}) != get_subtree_hash(counterpart, {}):
+                note = f"{describe_node(counterpart)} changed in the new original XML"
+            if note:
+                break
+
+    # Elements inserted into both trees correspond to each other, the following operations may target them
+    inserted = []
+    if problem is None and (operation.tag == 'add' and not operation.get('type') or operation.tag == 'replace' and whole):
+        for node, (counterpart, _) in zip(old_nodes, targets):
+            element = split_selected_node(node)[0]
+            if operation.tag == 'add':
+                inserted.append((element, counterpart, None, None))
+            elif element.getparent() is not None and counterpart.getparent() is not None:
+                inserted.append((element, counterpart, (element.getparent(), element.getparent().index(element)),
+                                 (counterpart.getparent(), counterpart.getparent().index(counterpart))))
+
+    apply_operation(operation, old_root, old_nodes)
+    if problem is None:
+        operation.set('sel', new_sel)
+        apply_operation(operation, new_root, new_nodes)
+    for element, counterpart, old_replaced_at, new_replaced_at in inserted:
+        for old_added, new_added in zip(find_added_elements(operation, element, old_replaced_at),
+                                        find_added_elements(operation, counterpart, new_replaced_at)):
+            counterparts.update(zip(old_added.iter(), new_added.iter()))
+    return new_sel, problem, note
+
+def remove_diff_operation(operation):
+    """
+    Removes an operation from the diff tree, keeping the indentation of the following ones.
+
+    Args:
+        operation (etree.Element): The operation element to remove.
+    """
+    previous = operation.getprevious()
+    parent = operation.getparent()
+    if previous is not None:
+        previous.tail = operation.tail
+    else:
+        parent.text = operation.tail
+    parent.remove(operation)
+
+def rebase_file(old_original_file, new_original_file, diff_file, output_file, diff_xsd_path, key_schema=None):
+    """
+    Re-anchors the operations of a diff made for the old original XML onto the new one and writes the result.
+    Operations which could not be placed are left out of the written diff.
+    It catches the errors and does not log the single steps, so it can run in a worker process.
+
+    Args:
+        old_original_file (str): Path to the original XML file the diff was made for.
+        new_original_file (str): Path to the new version of the original XML file.
         diff_file (str): Path to the diff XML file.
-        output_file (str): Path where the patched XML will be saved.
+        output_file (str): Path for the rebased diff XML file.
         diff_xsd_path (str): Path to the diff.xsd schema file.
+        key_schema (list): Matching keys as returned by load_key_schema. Defaults to the built-in ones.
 
     Returns:
-        None
+        tuple: A list of (number, operation, selector, new selector, problem, note) tuples and an error message;
+               the list is None if the diff could not be rebased at all.
     """
-    # Validate the diff file
+    if not os.path.isfile(old_original_file):
+        return None, f"Original XML file does not exist for diff file '{diff_file}'."
+    if not os.path.isfile(new_original_file):
+        return None, f"New original XML file does not exist for diff file '{diff_file}'."
     if not validate_diff_xml(diff_file, diff_xsd_path):
-        logging.error(f"Validation failed for diff file '{diff_file}'. Skipping.")
-        return
+        return None, f"Diff file '{diff_file}' is not valid against diff.xsd."
+    try:
+        old_root = etree.parse(old_original_file).getroot()
+        new_root = etree.parse(new_original_file).getroot()
+        diff_tree = etree.parse(diff_file)
+    except Exception as e:
+        return None, f"Error parsing '{diff_file}' or its original XML files: {e}"
 
-    # Parse the original XML file
+    key_rules = select_key_rules(key_schema or DEFAULT_KEY_SCHEMA, old_original_file)
+    counterparts = match_original_trees(old_root, new_root, key_rules)
+
+    results = []
+    operations = [operation for operation in diff_tree.getroot() if isinstance(operation.tag, str)]
+    # Only the report is of interest, not the single steps of applying the operations
+    logging.disable(logging.WARNING)
     try:
-        original_tree = etree.parse(original_file)
-        logging.info(f"Parsed original XML: {original_file}")
+        for number, operation in enumerate(operations, 1):
+            sel = operation.get('sel')
+            new_sel, problem, note = rebase_operation(operation, old_root, new_root, counterparts, key_rules)
+            if problem:
+                remove_diff_operation(operation)
+            results.append((number, operation.tag, sel, new_sel, problem, note))
     except Exception as e:
-        logging.error(f"Error parsing original XML '{original_file}': {e}")
-        return
+        return None, f"Error rebasing '{diff_file}': {e}"
+    finally:
+        logging.disable(logging.NOTSET)
 
-    # Parse the diff XML file
+    # The re-anchored selectors and the removed operations must still make a valid diff
     try:
-        parser = etree.XMLParser(remove_blank_text=False)
-        diff_tree = etree.parse(diff_file, parser)
-        logging.info(f"Parsed diff XML: {diff_file}")
+        xmlschema = load_xml_schema(diff_xsd_path)
     except Exception as e:
-        logging.error(f"Error parsing diff XML '{diff_file}': {e}")
-        return
+        return None, f"Error parsing diff.xsd: {e}"
+    if not xmlschema.validate(diff_tree):
+        error = xmlschema.error_log.last_error
+        return None, f"Rebased diff of '{diff_file}' is not valid against diff.xsd, line {error.line}: {error.message}"
 
-    # Detect indentation
-    indent_str = detect_indentation(original_file)
-    logging.info(f"Detected indentation for '{original_file}': '{repr(indent_str)}'")
+    try:
+        output_dir = os.path.dirname(output_file)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        # The operations keep their formatting, only the final line break is added as in the files of xml-diff.py
+        with open(output_file, 'wb') as f:
+            f.write(etree.tostring(diff_tree, xml_declaration=True, encoding='UTF-8') + b'\n')
+    except Exception as e:
+        return None, f"Error writing rebased diff '{output_file}': {e}"
+    return results, None
 
-    # Get the root element of the diff XML
-    diff_root = diff_tree.getroot()
+def report_rebase(diff_file, results):
+    """
+    Logs the rebase results of a diff file.
 
-    # Apply each operation in the diff XML
-    for operation in diff_root:
-        if operation.tag == 'add':
-            apply_add(operation, original_tree.getroot())
-        elif operation.tag == 'replace':
-            apply_replace(operation, original_tree.getroot())
-        elif operation.tag == 'remove':
-            apply_remove(operation, original_tree.getroot())
+    Args:
+        diff_file (str): Path or relative path of the diff XML file.
+        results (list): The results returned by rebase_file.
+
+    Returns:
+        int: Number of operations which could not be placed.
+    """
+    unplaced = sum(1 for _, _, _, _, problem, _ in results if problem)
+    moved = sum(1 for _, _, sel, new_sel, problem, _ in results if not problem and new_sel != sel)
+    changed = sum(1 for _, _, _, _, problem, note in results if not problem and note)
+    logging.info(f"Rebase of '{diff_file}': {len(results)} operation(s), {moved} re-anchored, "
+                 f"{changed} with changed targets, {unplaced} could not be placed.")
+    for number, tag, sel, new_sel, problem, note in results:
+        if problem:
+            logging.error(f"  #{number} {tag} {sel}: could not be placed, {problem}")
+        elif note:
+            logging.warning(f"  #{number} {tag} {new_sel}: {note}")
+        elif new_sel != sel:
+            logging.info(f"  #{number} {tag} {sel}: re-anchored as {new_sel}")
         else:
-            logging.warning(f"Unknown operation: {operation.tag} in diff file '{diff_file}'. Skipping.")
+            logging.debug(f"  #{number} {tag} {sel}: unchanged")
+    return unplaced
 
-    # Determine the output directory
-    output_dir = os.path.dirname(output_file)
+def rebase_directories(old_original_path, new_original_path, diff_path, output_path, diff_xsd_path, key_schema=None,
+                       jobs=None):
+    """
+    Rebases every diff file of a directory onto the new version of the corresponding original XML file,
+    in parallel processes. The results are reported in the order of the file paths.
 
-    # If the output path is a directory, append the original file name
-    if os.path.isdir(output_file):
-        output_dir = output_file
-        output_file = os.path.join(output_dir, os.path.basename(original_file))
+    Args:
+        old_original_path (str): Path to the original XML directory the diffs were made for.
+        new_original_path (str): Path to the new version of the original XML directory.
+        diff_path (str): Path to the diff XML directory.
+        output_path (str): Path for the rebased diff XML directory.
+        diff_xsd_path (str): Path to the diff.xsd schema file.
+        key_schema (list): Matching keys as returned by load_key_schema. Defaults to the built-in ones.
+        jobs (int): Number of worker processes, defaults to the number of CPUs.
 
-    # Ensure the output directory exists
-    if output_dir and not os.path.exists(output_dir):
-        try:
-            os.makedirs(output_dir)
-            logging.info(f"Created output directory: {output_dir}")
-        except Exception as e:
-            logging.error(f"Failed to create output directory '{output_dir}': {e}")
-            return
+    Returns:
+        tuple: Numbers of operations which could not be placed and of diff files that could not be rebased.
+    """
+    import concurrent.futures
+
+    relative_paths = []
+    for root, dirs, files in os.walk(diff_path):
+        for file in files:
+            if file.lower().endswith('.xml'):
+                relative_paths.append(os.path.relpath(os.path.join(root, file), diff_path))
+
+    unplaced = 0
+    errors = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=load_lxml) as executor:
+        futures = [
+            (relative_path, executor.submit(rebase_file, os.path.join(old_original_path, relative_path),
+                                            os.path.join(new_original_path, relative_path),
+                                            os.path.join(diff_path, relative_path),
+                                            os.path.join(output_path, relative_path), diff_xsd_path, key_schema))
+            for relative_path in sorted(relative_paths)
+        ]
+        for relative_path, future in futures:
+            results, message = future.result()
+            if results is None:
+                errors += 1
+                logging.error(message)
+            else:
+                unplaced += report_rebase(relative_path, results)
+    logging.info(f"Rebase of {len(relative_paths)} diff file(s): {unplaced} operation(s) could not be placed, "
+                 f"{errors} file(s) failed.")
+    return unplaced, errors
 
-    # Re-indent the entire XML tree for consistent formatting
-    if hasattr(etree, 'indent'):
-        etree.indent(original_tree, space=indent_str)
-        logging.info(f"Applied indentation to the output XML tree for '{output_file}'.")
+def run_patch_job(original_path, diff_path, output_path, diff_xsd_path, prefetch=0):
+    """
+    Applies the diff to a file or to all files of a directory, depending on the given paths.
 
-    # Write the patched XML to the output file
-    try:
-        original_tree.write(output_file, pretty_print=True, xml_declaration=True, encoding='utf-8')
-        logging.info(f"Patched XML successfully written to '{output_file}'.")
-    except Exception as e:
-        logging.error(f"Error writing patched XML to '{output_file}': {e}")
+    Args:
+        original_path (str): Path to the original XML file or directory.
+        diff_path (str): Path to the diff XML file or directory.
+        output_path (str): Path for the output XML file or directory.
+        diff_xsd_path (str): Path to the diff.xsd schema file.
+        prefetch (int): Number of file pairs to read ahead in directories, 0 to process the files one by one.
+
+    Returns:
+        bool: False if the paths do not match, True otherwise.
+    """
+    # Determine if original, diff, and output are directories or files
+    original_is_dir = os.path.isdir(original_path)
+    diff_is_dir = os.path.isdir(diff_path)
+    output_is_dir = os.path.isdir(output_path)
+
+    if original_is_dir and diff_is_dir and output_is_dir:
+        logging.info("original, Diff, and Output paths are all directories. Processing multiple files.")
+
+        process_directories(original_path, diff_path, output_path, diff_xsd_path, prefetch)
+    else:
+        if original_is_dir or diff_is_dir:
+            logging.error("If one of original, diff is a directory, both must be directories.")
+            return False
+
+        logging.info("original, Diff, and Output paths are all files. Processing single file.")
+
+        original_xml_path = original_path
+        diff_xml_path = diff_path
+        output_xml_path = output_path
+
+        # Process the single trio of diff, original, and output
+        process_single_file(original_xml_path, diff_xml_path, output_xml_path, diff_xsd_path)
+    return True
 
 def main():
     # Configure logging
@@ -383,7 +1163,22 @@ def main():
         ]
     )
 
-    original_path, diff_path, output_path, diff_xsd_path = parse_arguments()
+    (original_path, diff_path, output_path, diff_xsd_path, prefetch, dry_run, conflicts, jobs, batch_path, rebase_path,
+     keys_json_path) = parse_arguments()
+    load_lxml()
+
+    if batch_path and (dry_run or conflicts or rebase_path):
+        logging.error("The --dry-run, --conflicts and --rebase options cannot be used with --batch.")
+        sys.exit(2)
+
+    # The conflict report resolves the selectors only, it needs neither diff.xsd nor an output path
+    if conflicts:
+        original_is_dir = os.path.isdir(original_path)
+        if any(os.path.isdir(path) != original_is_dir for path in conflicts):
+            logging.error("If the original path is a directory, all mod diff paths must be directories, and vice versa.")
+            sys.exit(2)
+        conflicts_count, errors_count = check_conflicts(original_path, conflicts, jobs)
+        sys.exit(2 if errors_count else 1 if conflicts_count else 0)
 
     # Determine the path to diff.xsd
     if diff_xsd_path:
@@ -403,44 +1198,70 @@ def main():
             logging.error("diff.xsd not provided and not found in the script's directory.")
             sys.exit(1)
 
-    # Determine if original, diff, and output are directories or files
-    original_is_dir = os.path.isdir(original_path)
-    diff_is_dir = os.path.isdir(diff_path)
-    output_is_dir = os.path.isdir(output_path)
-
-    if original_is_dir and diff_is_dir and output_is_dir:
-        logging.info("original, Diff, and Output paths are all directories. Processing multiple files.")
-
-        # Traverse the diff directory
-        for root, dirs, files in os.walk(diff_path):
-            for file in files:
-                if file.lower().endswith('.xml'):
-                    diff_file_path = os.path.join(root, file)
-                    # Determine the relative path
-                    rel_path = os.path.relpath(diff_file_path, diff_path)
-                    original_file_path = os.path.join(original_path, rel_path)
-                    output_file_path = os.path.join(output_path, rel_path)
-
-                    if not os.path.isfile(original_file_path):
-                        logging.warning(f"original file does not exist for diff file '{diff_file_path}'. Skipping.")
-                        continue
-
-                    # Process the single trio of diff, original, and output
-                    process_single_file(original_file_path, diff_file_path, output_file_path, diff_xsd_path)
-
-    else:
-        if original_is_dir or diff_is_dir:
-            logging.error("If one of original, diff is a directory, both must be directories.")
+    # Run all jobs of the manifest in this process
+    if batch_path:
+        try:
+            batch_jobs = read_manifest(batch_path, 'diff')
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading batch manifest: {e}")
             sys.exit(1)
+        succeeded = run_batch(batch_jobs, lambda original, diff, output: run_patch_job(
+            original, diff, output, diff_xsd_path, prefetch))
+        sys.exit(0 if succeeded else 1)
 
-        logging.info("original, Diff, and Output paths are all files. Processing single file.")
-
-        original_xml_path = original_path
-        diff_xml_path = diff_path
-        output_xml_path = output_path
+    # The rebase writes the re-anchored diffs only, the original files are not patched
+    if rebase_path:
+        try:
+            key_schema = load_key_schema(keys_json_path)
+            if keys_json_path:
+                logging.info(f"Using matching keys from: {keys_json_path}")
+        except (OSError, ValueError) as e:
+            logging.error(f"Error loading matching keys: {e}")
+            sys.exit(2)
+        original_is_dir = os.path.isdir(original_path)
+        if os.path.isdir(rebase_path) != original_is_dir or os.path.isdir(diff_path) != original_is_dir:
+            logging.error("If one of original, new original and diff is a directory, all must be directories.")
+            sys.exit(2)
+        if original_is_dir:
+            unplaced, errors = rebase_directories(original_path, rebase_path, diff_path, output_path, diff_xsd_path,
+                                                  key_schema, jobs)
+        else:
+            # If the output path is a directory, write the rebased diff under the diff file name
+            if os.path.isdir(output_path):
+                output_path = os.path.join(output_path, os.path.basename(diff_path))
+            results, message = rebase_file(original_path, rebase_path, diff_path, output_path, diff_xsd_path, key_schema)
+            if results is None:
+                unplaced, errors = 0, 1
+                logging.error(message)
+            else:
+                unplaced, errors = report_rebase(diff_path, results), 0
+                logging.info(f"Rebased diff XML written to {output_path}")
+        sys.exit(2 if errors else 1 if unplaced else 0)
+
+    # The dry run only reports how the diffs apply, nothing is written
+    if dry_run:
+        original_is_dir = os.path.isdir(original_path)
+        diff_is_dir = os.path.isdir(diff_path)
+        if original_is_dir and diff_is_dir:
+            unmatched, errors = dry_run_directories(original_path, diff_path, diff_xsd_path, jobs)
+        elif not original_is_dir and not diff_is_dir:
+            results, message = dry_run_file(original_path, diff_path, diff_xsd_path)
+            if results is None:
+                unmatched, errors = 0, 1
+                logging.error(message)
+            else:
+                unmatched, errors = report_dry_run(diff_path, results), 0
+        else:
+            logging.error("If one of original, diff is a directory, both must be directories.")
+            sys.exit(2)
+        sys.exit(2 if errors else 1 if unmatched else 0)
 
-        # Process the single trio of diff, original, and output
-        process_single_file(original_xml_path, diff_xml_path, output_xml_path, diff_xsd_path)
+    if not run_patch_job(original_path, diff_path, output_path, diff_xsd_path, prefetch):
+        sys.exit(1)
 
 if __name__ == "__main__":
+    # Only the frozen executable starts its worker processes through main, a plain script needs no multiprocessing here
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
     main()
\ No newline at end of file
@@ -0,0 +1,689 @@
+import os
+import re
+import json
+import fnmatch
+import logging
+import hashlib
+import threading
+import functools
+
+# Code shared by xml-diff.py and xml-patch.py, keep it next to them.
+
+# Version of the cached indexes format, change it whenever the way the indexes are built changes
+CACHE_VERSION = '2'
+
+# Built-in matching keys for known X4 file families.
+# Each entry maps a file path pattern to the identity attributes of elements, given by tag,
+# by 'parent/tag', or by '*' for any element. The first matching definition of an element wins.
+DEFAULT_KEY_SCHEMA = [
+    ('md/*.xml', {'cue': ['name'], 'library': ['name'], 'param': ['name']}),
+    ('aiscripts/*.xml', {'param': ['name'], 'label': ['name'], 'library': ['name']}),
+    ('t/*.xml', {'page': ['id'], 'page/t': ['id']}),
+    ('index/*.xml', {'entry': ['name']}),
+    ('*', {'*': ['id']}),
+]
+
+# Attributes used to build readable selectors for elements without identity attributes
+SELECTOR_ATTRIBUTES = ['id', 'name', 'key', 'ref', 'value']
+
+# lxml takes a while to import, so it is loaded by load_lxml once there is XML to process
+etree = None
+
+def load_lxml():
+    """
+    Imports lxml on first use, the scripts call it from their own load_lxml.
+    """
+    global etree
+    if etree is None:
+        from lxml import etree as lxml_etree
+        etree = lxml_etree
+
+def resolve_selector(sel, original_root):
+    """
+    Finds the nodes selected by the 'sel' attribute of a diff operation.
+
+    Args:
+        sel (str): The XPath selector.
+        original_root (etree.Element): The root of the original XML tree.
+
+    Returns:
+        list: The selected elements, attributes and texts; empty if nothing matches.
+
+    Raises:
+        etree.XPathError: If the selector is not a valid XPath expression.
+    """
+    target_nodes = original_root.xpath(sel)
+    # Expressions like count() return a single value instead of nodes
+    if not isinstance(target_nodes, list):
+        return []
+    return target_nodes
+
+def apply_add(diff_element, original_root, target_nodes=None):
+    """
+    Applies the 'add' operation defined in the diff XML to the original XML.
+
+    Without 'pos' the new elements are appended to the selected element, 'prepend' inserts them
+    as its first children, 'before' and 'after' insert them as its siblings.
+    With the 'type' attribute set to '@name' an attribute is added to the selected element instead.
+
+    Args:
+        diff_element (etree.Element): The <add> element containing add operations.
+        original_root (etree.Element): The root of the original XML tree.
+        target_nodes (list): Nodes already selected by 'sel', they are resolved here if not provided.
+
+    Returns:
+        int: Number of nodes matched by the selector.
+    """
+    sel = diff_element.get('sel')
+    pos = diff_element.get('pos')
+    add_type = diff_element.get('type')
+    new_elements = [child for child in diff_element if isinstance(child.tag, str)]
+
+    if target_nodes is None:
+        target_nodes = resolve_selector(sel, original_root)
+    if not target_nodes:
+        logging.warning(f"No nodes found for add selector: {sel}")
+        return 0
+
+    if add_type and add_type.startswith('@'):
+        for target in target_nodes:
+            if isinstance(target, etree._Element):
+                target.set(add_type[1:], diff_element.text or '')
+                logging.info(f"Added attribute '{add_type[1:]}' to '{target.tag}'.")
+            else:
+                logging.warning(f"Unsupported node type for attribute addition: {type(target)}")
+        return len(target_nodes)
+
+    for target in target_nodes:
+        # Elements are inserted one after another, so keep the insertion point moving
+        offset = 0
+        for new_element in new_elements:
+            # Copy the new element to avoid modifying the original
+            new_elem_str = etree.tostring(new_element, encoding='utf-8').decode('utf-8')
+            # Remove the namespace declaration from the new element
+            clean_new_elem_str = re.sub(r'\sxmlns:xsi=".*?"', '', new_elem_str)
+            # Parse the cleaned new element
+            try:
+                new_elem = etree.fromstring(clean_new_elem_str)
+            except etree.XMLSyntaxError as e:
+                logging.error(f"Failed to parse cleaned new element: {e}")
+                continue
+
+            # Insert based on position
+            parent = target.getparent()
+            if pos is None:
+                target.append(new_elem)
+                logging.info(f"Appended new element '{new_elem.tag}' to '{target.tag}'.")
+            elif pos == 'prepend':
+                target.insert(offset, new_elem)
+                offset += 1
+                logging.info(f"Prepended new element '{new_elem.tag}' to '{target.tag}'.")
+            elif parent is not None:
+                if pos == 'before':
+                    parent.insert(parent.index(target), new_elem)
+                    logging.info(f"Added new element '{new_elem.tag}' before '{target.tag}' in '{parent.tag}'.")
+                elif pos == 'after':
+                    parent.insert(parent.index(target) + 1 + offset, new_elem)
+                    offset += 1
+                    logging.info(f"Added new element '{new_elem.tag}' after '{target.tag}' in '{parent.tag}'.")
+                else:
+                    logging.warning(f"Unknown position: {pos}. Skipping insertion.")
+    return len(target_nodes)
+
+def apply_replace(diff_element, original_root, target_nodes=None):
+    """
+    Applies the 'replace' operation defined in the diff XML to the original XML.
+
+    Args:
+        diff_element (etree.Element): The <replace> element containing replace operations.
+        original_root (etree.Element): The root of the original XML tree.
+        target_nodes (list): Nodes already selected by 'sel', they are resolved here if not provided.
+
+    Returns:
+        int: Number of nodes matched by the selector.
+    """
+    sel = diff_element.get('sel')
+    if sel is None:
+        logging.warning("Replace operation missing 'sel' attribute.")
+        return 0
+
+    # The new element for element replacement, the indentation around it is not a new text
+    new_element = next((child for child in diff_element if isinstance(child.tag, str)), None)
+    new_content = diff_element.text if new_element is None else None  # For text replacement
+
+    if target_nodes is None:
+        target_nodes = resolve_selector(sel, original_root)
+    if not target_nodes:
+        logging.warning(f"No nodes found for replace selector: {sel}")
+        return 0
+
+    for node in target_nodes:
+        if isinstance(node, etree._Element):
+            if new_content is not None:
+                # Replace element text
+                original_text = node.text
+                node.text = new_content
+                logging.debug(f"Replaced text of element '{node.tag}' from '{original_text}' to '{new_content}'.")
+            elif new_element is not None:
+                # Replace entire element with new_element subtree
+                try:
+                    replacement = etree.fromstring(etree.tostring(new_element, encoding='utf-8', with_tail=False))
+                    replacement.tail = node.tail
+                    parent = node.getparent()
+                    if parent is not None:
+                        parent.replace(node, replacement)
+                        logging.info(f"Replaced element '{node.tag}' with '{replacement.tag}'.")
+                except etree.XMLSyntaxError as e:
+                    logging.error(f"Invalid XML in <new> element: {e}")
+            else:
+                logging.warning(f"No replacement content provided for selector: {sel}")
+        elif isinstance(node, etree._ElementUnicodeResult) and node.is_attribute:
+            # Replacing an attribute value
+            parent = node.getparent()
+            attr = node.attrname
+            original_value = parent.get(attr)
+            parent.set(attr, new_content or '')
+            logging.debug(f"Replaced attribute '{attr}' of element '{parent.tag}' from '{original_value}' to '{new_content}'.")
+        elif isinstance(node, etree._ElementUnicodeResult) and node.is_text:
+            # Replacing a text node
+            parent = node.getparent()
+            parent.text = new_content
+            logging.debug(f"Replaced text of element '{parent.tag}' to '{new_content}'.")
+        else:
+            logging.warning(f"Unsupported node type for replacement: {type(node)}")
+    return len(target_nodes)
+
+def apply_remove(diff_element, original_root, target_nodes=None):
+    """
+    Applies the 'remove' operation defined in the diff XML to the original XML.
+
+    Args:
+        diff_element (etree.Element): The <remove> element containing remove operations.
+        original_root (etree.Element): The root of the original XML tree.
+        target_nodes (list): Nodes already selected by 'sel', they are resolved here if not provided.
+
+    Returns:
+        int: Number of nodes matched by the selector.
+    """
+    sel = diff_element.get('sel')
+    if sel is None:
+        logging.warning("Remove operation missing 'sel' attribute.")
+        return 0
+
+    if target_nodes is None:
+        target_nodes = resolve_selector(sel, original_root)
+    if not target_nodes:
+        logging.warning(f"No nodes found for remove selector: {sel}")
+        return 0
+
+    for node in target_nodes:
+        if isinstance(node, etree._ElementUnicodeResult):
+            # Removing an attribute or a text node
+            parent = node.getparent()
+            if node.is_attribute:
+                del parent.attrib[node.attrname]
+                logging.debug(f"Removed attribute '{node.attrname}' from '{parent.tag}'.")
+            elif node.is_text:
+                parent.text = None
+                logging.debug(f"Removed text of element '{parent.tag}'.")
+            else:
+                logging.warning(f"Unsupported node type for removal: {type(node)}")
+            continue
+
+        parent = node.getparent()
+        if parent is None:
+            logging.warning(f"Cannot remove root element '{node.tag}'. Skipping.")
+            continue
+
+        # Remove the node
+        parent.remove(node)
+        logging.debug(f"Removed element '{node.tag}' from '{parent.tag}'.")
+
+        # Adjust indentation
+        # If the removed node had a tail with indentation, propagate it to the previous sibling or parent
+        if node.tail and node.tail.strip() == '':
+            index = parent.index(node) if node in parent else -1
+            if index > 0:
+                # Get the previous sibling
+                prev_sibling = parent[index - 1]
+                if prev_sibling.tail is not None:
+                    # Append the removed node's tail to the previous sibling's tail
+                    prev_sibling.tail += node.tail
+                else:
+                    prev_sibling.tail = node.tail
+            else:
+                # If there is no previous sibling, adjust the parent's text or tail
+                if parent.text is not None:
+                    parent.text += node.tail
+                else:
+                    parent.text = node.tail
+
+        # Optional: Clean stray whitespace
+        clean_whitespace(parent)
+    return len(target_nodes)
+
+def apply_operation(operation, original_root, target_nodes=None):
+    """
+    Applies a single operation of the diff XML to the original XML.
+
+    Args:
+        operation (etree.Element): The <add>, <replace> or <remove> element.
+        original_root (etree.Element): The root of the original XML tree.
+        target_nodes (list): Nodes already selected by 'sel', they are resolved here if not provided.
+
+    Returns:
+        int: Number of nodes matched by the selector, or None for an unknown operation.
+    """
+    if operation.tag == 'add':
+        return apply_add(operation, original_root, target_nodes)
+    elif operation.tag == 'replace':
+        return apply_replace(operation, original_root, target_nodes)
+    elif operation.tag == 'remove':
+        return apply_remove(operation, original_root, target_nodes)
+    return None
+
+def clean_whitespace(parent):
+    """
+    Cleans up stray whitespace in the XML tree after removal operations.
+
+    Only missing or whitespace-only texts are replaced, the real ones are kept.
+
+    Args:
+        parent (etree.Element): The parent element whose children may have stray whitespace.
+    """
+    if len(parent) > 0:
+        # Ensure the last child has a tail with proper indentation
+        last_child = parent[-1]
+        if not last_child.tail or not last_child.tail.strip():
+            last_child.tail = '\n' + '    ' * (get_element_level(last_child) - 1)
+    else:
+        # If the parent has no children, adjust its text
+        if not parent.text or not parent.text.strip():
+            parent.text = '\n' + '    ' * (get_element_level(parent) - 1)
+
+def get_element_level(element):
+    """
+    Determines the depth level of an element in the XML tree.
+
+    Args:
+        element (etree.Element): The element whose level is to be determined.
+
+    Returns:
+        int: The depth level of the element (root is 0).
+    """
+    level = 0
+    parent = element.getparent()
+    while parent is not None:
+        level += 1
+        parent = parent.getparent()
+    return level
+
+def get_cache_entry_path(cache_dir, content_hash, key_rules):
+    """
+    Returns the path of the cache entry for an original XML file.
+
+    The entry name depends on the file content, the cache format version and the matching keys,
+    so any game update or tool change results in a new entry, while the outdated ones are evicted.
+
+    Args:
+        cache_dir (str): Path to the cache directory.
+        content_hash (str): SHA-256 hex digest of the original XML file content.
+        key_rules (dict): Matching keys for the file.
+
+    Returns:
+        str: Path to the cache entry file.
+    """
+    entry_key = f"{CACHE_VERSION}\0{etree.LXML_VERSION}\0{content_hash}\0{sorted(key_rules.items())}"
+    return os.path.join(cache_dir, hashlib.sha256(entry_key.encode('utf-8')).hexdigest() + '.pickle')
+
+def read_cache_entry(entry_path):
+    """
+    Reads a cache entry and marks it as recently used.
+
+    Args:
+        entry_path (str): Path to the cache entry file.
+
+    Returns:
+        dict: The cached data, or None if there is no usable entry.
+    """
+    import pickle
+
+    try:
+        with open(entry_path, 'rb') as f:
+            entry = pickle.load(f)
+        os.utime(entry_path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Discarding unreadable cache entry '{entry_path}': {e}")
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
+        return None
+    if not isinstance(entry, dict) or entry.get('version') != CACHE_VERSION:
+        return None
+    return entry
+
+def write_cache_entry(entry_path, entry, cache_size):
+    """
+    Writes a cache entry atomically and evicts the least recently used entries above the size cap.
+
+    Args:
+        entry_path (str): Path to the cache entry file.
+        entry (dict): The data to cache.
+        cache_size (int): Maximum total size of the cache directory in bytes.
+    """
+    import pickle
+
+    cache_dir = os.path.dirname(entry_path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, entry_path)
+    except Exception as e:
+        logging.warning(f"Failed to write cache entry '{entry_path}': {e}")
+        return
+
+    # Evict the least recently used entries
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pickle'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(cache_dir, name)))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= cache_size:
+            break
+        if path == entry_path:
+            continue
+        try:
+            os.remove(path)
+            total_size -= size
+            logging.debug(f"Evicted cache entry: {path}")
+        except OSError:
+            pass
+
+def load_key_schema(keys_path=None):
+    """
+    Loads the user-supplied matching keys and combines them with the built-in defaults.
+
+    The file is a JSON object mapping file path patterns to objects, which map element patterns
+    to lists of identity attributes, e.g. {"md/*.xml": {"cue": ["name"]}}.
+
+    Args:
+        keys_path (str): Path to the JSON file with matching keys, or None for the defaults only.
+
+    Returns:
+        list: (file pattern, rules) pairs, user-supplied ones first.
+
+    Raises:
+        ValueError: If the file does not follow the expected structure.
+    """
+    key_schema = []
+    if keys_path:
+        with open(keys_path, 'r', encoding='utf-8') as f:
+            user_schema = json.load(f)
+        if not isinstance(user_schema, dict):
+            raise ValueError("Matching keys file must contain a JSON object.")
+        for file_pattern, rules in user_schema.items():
+            if not isinstance(rules, dict) or not all(
+                isinstance(attrs, list) and all(isinstance(attr, str) for attr in attrs) for attrs in rules.values()
+            ):
+                raise ValueError(f"Rules for '{file_pattern}' must map element patterns to lists of attribute names.")
+            key_schema.append((file_pattern, rules))
+    key_schema.extend(DEFAULT_KEY_SCHEMA)
+    return key_schema
+
+def select_key_rules(key_schema, xml_path):
+    """
+    Combines the rules of all key schema entries matching the given file.
+
+    Args:
+        key_schema (list): (file pattern, rules) pairs as returned by load_key_schema.
+        xml_path (str): Path to the XML file.
+
+    Returns:
+        dict: Element pattern to list of identity attributes.
+    """
+    normalized_path = xml_path.replace(os.sep, '/')
+    key_rules = {}
+    for file_pattern, rules in key_schema:
+        if fnmatch.fnmatch(normalized_path, file_pattern) or fnmatch.fnmatch(normalized_path, f'*/{file_pattern}'):
+            for element_pattern, attrs in rules.items():
+                key_rules.setdefault(element_pattern, attrs)
+    return key_rules
+
+def xpath_literal(value):
+    """
+    Quotes a value for use as a string literal in an XPath expression.
+
+    Args:
+        value (str): The value to quote.
+
+    Returns:
+        str: The quoted literal.
+    """
+    if '"' not in value:
+        return f'"{value}"'
+    if "'" not in value:
+        return f"'{value}'"
+    return 'concat(' + ", '\"', ".join(f'"{part}"' for part in value.split('"')) + ')'
+
+def index_children(parent, key_rules, rules_cache, counts):
+    """
+    Computes the identity of the child elements of the given element.
+
+    A child is identified by the first of its identity attributes whose value is unique among
+    its siblings with the same tag, otherwise by its position among the siblings identified
+    the same way, so a keyed sibling added or removed does not shift it.
+
+    Args:
+        parent (etree.Element): The element whose children are indexed.
+        key_rules (dict): Element pattern to list of identity attributes, as returned by select_key_rules.
+        rules_cache (dict): Cache of resolved identity and selector attributes per (parent tag, tag).
+        counts (dict): Mapping of (tag, attribute, value) to the number of elements carrying it, updated in place.
+
+    Returns:
+        dict: Each child element to a tuple of its matching key, its XPath step and the attributes
+            suitable for a '//' selector.
+    """
+    parent_tag = parent.tag
+    children = []
+    tag_counts = {}
+    value_counts = {}
+    for child in parent.iterchildren(etree.Element):
+        tag = child.tag
+        tag_counts[tag] = tag_counts.get(tag, 0) + 1
+        rules = rules_cache.get((parent_tag, tag))
+        if rules is None:
+            if f'{parent_tag}/{tag}' in key_rules:
+                key_attrs = key_rules[f'{parent_tag}/{tag}']
+            elif tag in key_rules:
+                key_attrs = key_rules[tag]
+            else:
+                key_attrs = key_rules.get('*', [])
+            rules = (key_attrs, key_attrs + [attr for attr in SELECTOR_ATTRIBUTES if attr not in key_attrs])
+            rules_cache[(parent_tag, tag)] = rules
+        attrib = dict(child.items())
+        values = [(attr, attrib[attr]) for attr in rules[1] if attr in attrib] if attrib else []
+        for attr, value in values:
+            value_key = (tag, attr, value)
+            value_counts[value_key] = value_counts.get(value_key, 0) + 1
+            counts[value_key] = counts.get(value_key, 0) + 1
+        children.append((child, tag, rules[0], values))
+
+    indexed = {}
+    positions = {}
+    keyless_positions = {}
+    for child, tag, key_attrs, values in children:
+        positions[tag] = positions.get(tag, 0) + 1
+        positional = f'{tag}[{positions[tag]}]'
+        unique_values = [(attr, value) for attr, value in values if value_counts[(tag, attr, value)] == 1]
+
+        match_key = None
+        for attr, value in unique_values:
+            if attr in key_attrs:
+                match_key = f'{tag}[@{attr}={xpath_literal(value)}]'
+                break
+        if match_key is None:
+            keyless_positions[tag] = keyless_positions.get(tag, 0) + 1
+            match_key = f'{tag}[{keyless_positions[tag]}]'
+
+        if tag_counts[tag] == 1:
+            step = tag
+        elif unique_values:
+            step = f'{tag}[@{unique_values[0][0]}={xpath_literal(unique_values[0][1])}]'
+        else:
+            step = positional
+        indexed[child] = (match_key, step, [attr for attr, _ in values])
+    return indexed
+
+def get_subtree_hash(elem, hashes):
+    """
+    Returns a canonical hash of the subtree, ignoring attribute order, whitespace around text,
+    tails, comments and processing instructions - the same things the comparison ignores.
+
+    Args:
+        elem (etree.Element): The root element of the subtree.
+        hashes (dict): Already computed digests per element, updated in place.
+
+    Returns:
+        bytes: The digest of the subtree.
+    """
+    digest = hashes.get(elem)
+    if digest is None:
+        text = elem.text.strip() if elem.text else ''
+        data = f'{elem.tag}\0{sorted(elem.items())!r}\0{text}\0'.encode('utf-8')
+        data += b''.join([get_subtree_hash(child, hashes) for child in elem.iterchildren(etree.Element)])
+        digest = hashes[elem] = hashlib.sha1(data).digest()
+    return digest
+
+def read_manifest(manifest_path, second_field):
+    """
+    Reads the jobs of a batch manifest.
+
+    A JSON manifest is a list of jobs, or an object with such a list under 'jobs'. Each job is a list
+    of three paths, or an object with the 'original', second_field and 'output' paths.
+    Any other manifest has a job per line with three paths separated by tabs, or by spaces if the paths
+    have none. Empty lines and lines starting with '#' are skipped.
+    Relative paths are relative to the directory of the manifest.
+
+    Args:
+        manifest_path (str): Path to the manifest file.
+        second_field (str): Name of the second path of a job - 'modified' or 'diff'.
+
+    Returns:
+        list: (original, second, output) tuples of absolute paths.
+
+    Raises:
+        ValueError: If the manifest is malformed.
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    fields = ('original', second_field, 'output')
+
+    raw_jobs = []
+    if content.lstrip().startswith(('[', '{')):
+        manifest = json.loads(content)
+        if isinstance(manifest, dict):
+            manifest = manifest.get('jobs')
+        if not isinstance(manifest, list):
+            raise ValueError(f"{manifest_path}: expected a list of jobs")
+        for number, job in enumerate(manifest, 1):
+            if isinstance(job, dict):
+                job = [job.get(field) for field in fields]
+            if not isinstance(job, list) or len(job) != 3 or not all(isinstance(path, str) and path for path in job):
+                raise ValueError(f"{manifest_path}: job {number} should have the {', '.join(fields)} paths")
+            raw_jobs.append(job)
+    else:
+        for line_number, line in enumerate(content.splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            job = [path.strip() for path in (line.split('\t') if '\t' in line else line.split()) if path.strip()]
+            if len(job) != 3:
+                raise ValueError(f"{manifest_path}: line {line_number} should have the {', '.join(fields)} paths")
+            raw_jobs.append(job)
+
+    base_dir = os.path.dirname(manifest_path)
+    return [tuple(os.path.abspath(os.path.join(base_dir, path)) for path in job) for job in raw_jobs]
+
+def run_batch(batch_jobs, run_job):
+    """
+    Runs the jobs of a batch manifest one by one in this process and reports the status of each.
+    A job fails if it returns False or logs any error.
+
+    Args:
+        batch_jobs (list): Path tuples as returned by read_manifest.
+        run_job (callable): Runs a single job, called with the paths of the job.
+
+    Returns:
+        bool: True if all jobs succeeded.
+    """
+    error_records = []
+
+    def count_errors(record):
+        if record.levelno >= logging.ERROR:
+            error_records.append(record)
+        return True
+
+    statuses = []
+    root_logger = logging.getLogger()
+    root_logger.addFilter(count_errors)
+    try:
+        for number, job in enumerate(batch_jobs, 1):
+            logging.info(f"Batch job {number}/{len(batch_jobs)}: {' -> '.join(job)}")
+            errors_before = len(error_records)
+            try:
+                succeeded = run_job(*job) is not False
+            except Exception as e:
+                logging.error(f"Batch job {number} failed: {e}")
+                succeeded = False
+            errors = len(error_records) - errors_before
+            status = 'OK' if succeeded and not errors else 'FAILED'
+            statuses.append((number, job, status, errors))
+            logging.info(f"Batch job {number}/{len(batch_jobs)}: {status}" + (f", {errors} error(s)" if errors else ''))
+    finally:
+        root_logger.removeFilter(count_errors)
+
+    logging.info("Batch results:")
+    for number, job, status, errors in statuses:
+        logging.info(f"  {status} #{number} {job[-1]}")
+    return all(status == 'OK' for _, _, status, _ in statuses)
+
+@functools.lru_cache(maxsize=None)
+def load_xml_schema(xsd_path):
+    """
+    Parses the XSD schema file once per run.
+
+    Args:
+        xsd_path (str): Path to the XSD schema file.
+
+    Returns:
+        etree.XMLSchema: The parsed schema.
+    """
+    with open(xsd_path, 'rb') as f:
+        return etree.XMLSchema(etree.parse(f))
+
+def run_writer(write_queue):
+    """
+    Runs the writer thread of the pipelined directory processing, until it gets None from the queue.
+
+    Args:
+        write_queue (queue.Queue): Queue of (function, arguments) pairs to call.
+    """
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        function, arguments = item
+        try:
+            function(*arguments)
+        except Exception as e:
+            logging.error(f"Error writing output: {e}")